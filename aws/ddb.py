@@ -1,7 +1,6 @@
-import boto3
+import aws.ec2
 import pager
 import json
-import contextlib
 import logging
 import os
 import shell
@@ -10,27 +9,18 @@ import util.colors
 import util.log
 import util.time
 from unittest import mock
+from aws.ec2 import _region
 
 
 is_cli = False
 
 
 def _resource():
-    return boto3.resource('dynamodb')
+    return aws.ec2._cached_resource('dynamodb')
 
 
 def _client():
-    return boto3.client('dynamodb')
-
-
-@contextlib.contextmanager
-def _region(name):
-    session = boto3.DEFAULT_SESSION
-    boto3.setup_default_session(region_name=name)
-    try:
-        yield
-    finally:
-        boto3.DEFAULT_SESSION = session
+    return aws.ec2._cached_client('dynamodb')
 
 
 def delete_table(name, yes=False):
@@ -1,25 +1,40 @@
 import argh
+import asyncio
+import atexit
+import base64
 import copy
 import boto3
+import botocore.config
 import requests
 import hashlib
+import heapq
+import fnmatch
+import ipaddress
 import uuid
 import collections
 import json
 import contextlib
 import datetime
+import glob
 import itertools
 import logging
 import os
 import pager
 import pool.thread
 import pprint
+import queue
 import random
 import re
 import shell
 import shell.conf
+import shlex
+import shutil
+import sqlite3
+import string
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import util.cached
 import util.colors
@@ -40,6 +55,38 @@ is_cli = False
 
 ssh_args = ' -q -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no '
 
+# give up on hosts which stop answering, like a reclaimed spot instance,
+# instead of leaving long running ssh sessions hanging forever
+_keepalive_args = ' -o ConnectTimeout=10 -o ServerAliveInterval=15 -o ServerAliveCountMax=3 '
+
+
+_control_lock = threading.Lock()
+_control_dir = None
+
+
+def _ssh_args():
+    """
+    ssh_args plus keepalives and connection multiplexing. the first ssh to a host
+    starts a master connection, and later ssh and scp calls to that
+    host reuse it instead of doing a fresh tcp connect and key exchange.
+    masters are shut down when this process exits.
+    """
+    global _control_dir
+    with _control_lock:
+        if _control_dir is None:
+            _control_dir = tempfile.mkdtemp(prefix='py-aws-ssh.', dir='/tmp') # short path, unix sockets are limited to ~100 chars
+            atexit.register(_close_ssh_masters)
+    return ssh_args + _keepalive_args + '-o ControlMaster=auto -o ControlPath=' + _control_dir + '/%C -o ControlPersist=60 '
+
+
+def _close_ssh_masters():
+    for path in glob.glob(os.path.join(_control_dir, '*')):
+        subprocess.call(['ssh', '-o', 'ControlPath=' + path, '-O', 'exit', 'localhost'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(_control_dir, ignore_errors=True)
+
+
+_max_threads = 20 # default fan-out for ssh, scp and push, also used to size boto3 connection pools
+
 
 def _now():
     return str(datetime.datetime.utcnow().isoformat()) + 'Z'
@@ -61,30 +108,274 @@ def _retry(f):
     return fn
 
 
-def _resource():
-    return boto3.resource('ec2')
-
-
-def _client():
-    return boto3.client('ec2')
+_boto_lock = threading.Lock() # guards the dicts below, and is never held while loading service models
+_boto_sessions = {}
+_boto_region_locks = {}
+_boto_cache = {}
+_boto_pool_connections = 5 * _max_threads # shared clients serve every thread of a fan-out
+_local = threading.local()
 
 
 @contextlib.contextmanager
 def _region(name):
-    session = boto3.DEFAULT_SESSION
-    boto3.setup_default_session(region_name=name)
+    """
+    set the region for boto3 calls made from the current thread. this
+    does not touch boto3.DEFAULT_SESSION, so many threads can each use
+    a different region at the same time. threads do not inherit the
+    region, use _in_region() to carry it over to a worker fn.
+    """
+    old = getattr(_local, 'region', None)
+    if name:
+        _local.region = name
     try:
         yield
     finally:
-        boto3.DEFAULT_SESSION = session
+        _local.region = old
+
+
+def _region_name():
+    return getattr(_local, 'region', None)
+
+
+def _in_region(f):
+    name = _region_name()
+    def fn(*a, **kw):
+        with _region(name):
+            return f(*a, **kw)
+    return fn
+
+
+def _map_regions(f):
+    """
+    call f concurrently in every region, returning sorted [(region, list(f())), ...]
+    """
+    def fn(name):
+        with _region(name):
+            try:
+                return name, list(f())
+            except SystemExit: # cli fns exit 1 when there are no results
+                return name, []
+    return sorted(pool.thread.map(fn, regions()), key=lambda x: x[0])
+
+
+def _session():
+    """
+    one boto3 session per region, shared by every thread, so service models
+    are loaded once per region instead of once per thread.
+    """
+    region = _region_name()
+    try:
+        return _boto_sessions[region]
+    except KeyError:
+        with _boto_lock:
+            if region not in _boto_sessions:
+                _boto_sessions[region] = boto3.session.Session(region_name=region)
+                _boto_region_locks[region] = threading.Lock()
+            return _boto_sessions[region]
+
+
+def _boto(kind, service):
+    """
+    clients are thread safe, so there is one per (service, region), shared
+    by all threads. resources are not, so there is one per (service,
+    region, thread), dropped once the thread exits. sessions are not thread
+    safe either, so these are made under a per region lock.
+    """
+    region = _region_name()
+    key = (kind, service, region, threading.get_ident() if kind == 'resource' else None)
+    try:
+        return _boto_cache[key]
+    except KeyError:
+        session = _session()
+        with _boto_region_locks[region]:
+            if key not in _boto_cache:
+                if kind == 'resource':
+                    alive = {t.ident for t in threading.enumerate()}
+                    for k in [k for k in list(_boto_cache) if k[3] is not None and k[3] not in alive]:
+                        _boto_cache.pop(k, None)
+                config = botocore.config.Config(max_pool_connections=_boto_pool_connections)
+                _boto_cache[key] = getattr(session, kind)(service, config=config)
+            return _boto_cache[key]
+
+
+def _cached_client(service):
+    return _boto('client', service)
+
+
+def _cached_resource(service):
+    return _boto('resource', service)
+
+
+def _resource():
+    return _cached_resource('ec2')
+
+
+def _client():
+    return _cached_client('ec2')
+
+
+# opt-in local cache of describe-instances results, enabled by setting
+# this env var to a number of seconds. mutating commands invalidate it.
+_inventory_ttl = float(os.environ.get('ec2_inventory_ttl') or 0)
+
+
+def _inventory_cache_path(filters):
+    credentials = _session().get_credentials()
+    key = json.dumps([credentials.access_key if credentials else None, _current_region(), filters], sort_keys=True)
+    key = hashlib.sha1(bytes(key, 'utf-8')).hexdigest()
+    return '/tmp/cache.py-aws.instances.%(key)s.json' % locals()
+
+
+def _invalidate_inventory():
+    for path in glob.glob('/tmp/cache.py-aws.instances.*.json'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _Instance:
+    """
+    a compact record of one instance from describe-instances. everything
+    is parsed up front, so unlike a boto3 Instance, reading attributes
+    never triggers another api call.
+    """
+
+    __slots__ = ['instance_id',
+                 'instance_type',
+                 'image_id',
+                 'state_name',
+                 'launch_time',
+                 'spot_instance_request_id',
+                 'public_dns_name',
+                 'public_ip_address',
+                 'private_dns_name',
+                 'private_ip_address',
+                 'subnet_id',
+                 'vpc_id',
+                 'security_group_names',
+                 'tags']
+
+    def __init__(self, data):
+        self.instance_id = data['InstanceId']
+        self.instance_type = data['InstanceType']
+        self.image_id = data.get('ImageId')
+        self.state_name = data['State']['Name']
+        self.launch_time = data['LaunchTime'] if isinstance(data['LaunchTime'], str) else data['LaunchTime'].isoformat()
+        self.spot_instance_request_id = data.get('SpotInstanceRequestId')
+        self.public_dns_name = data.get('PublicDnsName') or ''
+        self.public_ip_address = data.get('PublicIpAddress')
+        self.private_dns_name = data.get('PrivateDnsName') or ''
+        self.private_ip_address = data.get('PrivateIpAddress')
+        self.subnet_id = data.get('SubnetId')
+        self.vpc_id = data.get('VpcId')
+        self.security_group_names = tuple(x['GroupName'] for x in data.get('SecurityGroups', []))
+        self.tags = {x['Key']: x['Value'] for x in data.get('Tags', [])}
+
+    def __eq__(self, other):
+        return isinstance(other, _Instance) and self.instance_id == other.instance_id
+
+    def __hash__(self):
+        return hash(self.instance_id)
+
+    def __repr__(self):
+        return '_Instance(%s)' % self.instance_id
+
+
+def _describe_instances(filters, cache=True):
+    """
+    describe-instances as _Instance records, parsed a page at a time.
+    """
+    cache = cache and _inventory_ttl
+    if cache:
+        path = _inventory_cache_path(filters)
+        try:
+            if time.time() - os.stat(path).st_mtime < _inventory_ttl:
+                with open(path) as f:
+                    return [_Instance(x) for x in json.load(f)]
+        except (IOError, ValueError):
+            pass
+    instances = []
+    raw = []
+    for page in _client().get_paginator('describe_instances').paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for data in reservation['Instances']:
+                instances.append(_Instance(data))
+                if cache:
+                    raw.append(data)
+    if cache:
+        with tempfile.NamedTemporaryFile('w', dir='/tmp', prefix='cache.py-aws.tmp.', delete=False) as f:
+            json.dump(raw, f, default=lambda x: x.isoformat())
+        os.rename(f.name, path)
+    return instances
 
 
 def _tags(instance):
+    if isinstance(instance, _Instance):
+        return instance.tags
     return {x['Key']: x['Value'] for x in (instance.tags or {})}
 
 
+_identity_filters = ['instance-id', 'dns-name', 'private-dns-name', 'ip-address', 'private-ip-address']
+_scope_filters = ['vpc-id', 'subnet-id', 'instance.group-id']
+
+
+def _selector_filter(selector):
+    if '=' in selector:
+        return 'tag'
+    elif re.match(r'i\-[a-zA-Z0-9]{8}', selector):
+        return 'instance-id'
+    elif selector.endswith('.amazonaws.com'):
+        return 'dns-name'
+    elif selector.endswith('.ec2.internal') or selector.endswith('.compute.internal'):
+        return 'private-dns-name'
+    elif selector.startswith('vpc-'):
+        return 'vpc-id'
+    elif selector.startswith('subnet-'):
+        return 'subnet-id'
+    elif selector.startswith('sg-'):
+        return 'instance.group-id' # ec2 modern
+    else:
+        try:
+            ip = ipaddress.ip_address(selector)
+        except ValueError:
+            return 'name'
+        else:
+            return 'private-ip-address' if ip.is_private else 'ip-address'
+
+
+def _plan_filters(selectors, state):
+    """
+    turn selectors into the minimal list of describe-instances filter
+    sets. identity selectors, like ids, dns names and ips, are unioned
+    together. scope selectors, like vpcs, subnets, sgs and tags, narrow
+    every filter set, with values of the same tag key ored together. a
+    bare word is shorthand for Name=<word>.
+    """
+    groups = collections.defaultdict(list)
+    for selector in selectors:
+        name = _selector_filter(selector)
+        if name == 'name':
+            name, selector = 'tag', 'Name=%s' % selector
+        groups[name].append(selector)
+    scope = [{'Name': 'instance-state-name', 'Values': state}] if state[0] != 'all' else []
+    for name in _scope_filters:
+        if groups[name]:
+            assert len(groups[name]) <= 195, 'too many %s values: %s' % (name, len(groups[name])) # 200 boto api limit
+            scope.append({'Name': name, 'Values': groups[name]})
+    tags = collections.OrderedDict() # values of one key are ored together, different keys are anded
+    for tag in groups['tag']:
+        name, value = tag.split('=', 1)
+        tags.setdefault(name, []).append(value)
+    scope += [{'Name': 'tag:%s' % name, 'Values': values} for name, values in tags.items()]
+    plans = [scope + [{'Name': name, 'Values': list(chunk)}]
+             for name in _identity_filters
+             for chunk in util.iter.chunk(groups[name], 195)] # 200 boto api limit
+    return plans or [scope]
+
+
 @_retry
-def _ls(tags, state='running', first_n=None, last_n=None):
+def _ls(tags, state='running', first_n=None, last_n=None, cache=True):
     if isinstance(state, str):
         state = state.lower()
         assert state in ['running', 'pending', 'stopped', 'terminated', 'all'], 'no such state: ' + state
@@ -93,54 +384,14 @@ def _ls(tags, state='running', first_n=None, last_n=None):
         state = [s.lower() for s in state]
         for s in state:
             assert s in ['running', 'pending', 'stopped', 'terminated', 'all'], 'no such state: ' + s
-    is_dns_name = tags and tags[0].endswith('.amazonaws.com')
-    is_vpc_id = tags and tags[0].startswith('vpc-')
-    is_subnet_id = tags and tags[0].startswith('subnet-')
-    is_sg_id = tags and tags[0].startswith('sg-')
-    is_priv_dns_name = tags and tags[0].endswith('.ec2.internal')
-    is_ipv4 = tags and all(x.isdigit() or x == '.' for x in tags[0])
-    is_priv_ipv4 = tags and all(x.isdigit() or x == '.' for x in tags[0]) and tags[0].startswith('10.')
-    is_instance_id = tags and re.search(r'i\-[a-zA-Z0-9]{8}', tags[0])
-    if tags and not is_subnet_id and not is_vpc_id and not is_dns_name and not is_sg_id and not is_instance_id and not is_ipv4 and not is_priv_ipv4 and not is_priv_dns_name and '=' not in tags[0]:
-        tags = ('Name=%s' % tags[0],) + tuple(tags[1:])
-    instances = []
-    if not tags:
-        filters = [{'Name': 'instance-state-name', 'Values': state}] if state[0] != 'all' else []
-        instances += list(_resource().instances.filter(Filters=filters))
+    plans = _plan_filters(tags or [], state)
+    if len(plans) == 1:
+        results = [_describe_instances(plans[0], cache)]
     else:
-        for tags_chunk in util.iter.chunk(tags, 195): # 200 boto api limit
-            filters = [{'Name': 'instance-state-name', 'Values': state}] if state[0] != 'all' else []
-            if is_dns_name:
-                filters += [{'Name': 'dns-name', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_priv_dns_name:
-                filters += [{'Name': 'private-dns-name', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_vpc_id:
-                filters += [{'Name': 'vpc-id', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_subnet_id:
-                filters += [{'Name': 'subnet-id', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_priv_ipv4:
-                filters += [{'Name': 'private-ip-address', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_ipv4:
-                filters += [{'Name': 'ip-address', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_instance_id:
-                filters += [{'Name': 'instance-id', 'Values': tags_chunk}]
-                instances += list(_resource().instances.filter(Filters=filters))
-            elif is_sg_id:
-                filters += [{'Name': 'instance.group-id', 'Values': tags_chunk}] # ec2 modern
-                instances += list(_resource().instances.filter(Filters=filters))
-            else:
-                filters += [{'Name': 'tag:%s' % name, 'Values': [value]}
-                            for tag in tags_chunk
-                            for name, value in [tag.split('=')]]
-                instances += list(_resource().instances.filter(Filters=filters))
+        results = pool.thread.map(_in_region(lambda filters: _describe_instances(filters, cache)), plans)
+    instances = list({i.instance_id: i for xs in results for i in xs}.values())
     instances = sorted(instances, key=_name_group)
-    instances = sorted(instances, key=lambda i: i.meta.data['LaunchTime'], reverse=True)
+    instances = sorted(instances, key=lambda i: i.launch_time, reverse=True)
     if first_n:
         instances = instances[:int(first_n)]
     elif last_n:
@@ -149,29 +400,26 @@ def _ls(tags, state='running', first_n=None, last_n=None):
 
 
 def _pretty(instance, ip=False, all_tags=False):
-    @_retry
-    def f():
-        if instance.state['Name'] == 'running':
-            color = util.colors.green
-        elif instance.state['Name'] == 'pending':
-            color = util.colors.cyan
-        else:
-            color = util.colors.red
-        return ' '.join(filter(None, [
-            color(_name(instance)),
-            instance.instance_type,
-            instance.state['Name'],
-            instance.instance_id,
-            instance.image_id,
-            ('spot' if instance.spot_instance_request_id else 'ondemand'),
-            (instance.public_dns_name or '<no-ip>' if ip else None),
-            ','.join([x['GroupName'] for x in instance.security_groups]),
-            ' '.join('%s=%s' % (k, v)
-                     for k, v in sorted(_tags(instance).items(), key=lambda x: x[0])
-                     if (all_tags or k not in ['Name', 'creation-date', 'owner', 'launch', 'aws:ec2spot:fleet-request-id'])
-                     and v),
-        ]))
-    return f()
+    if instance.state_name == 'running':
+        color = util.colors.green
+    elif instance.state_name == 'pending':
+        color = util.colors.cyan
+    else:
+        color = util.colors.red
+    return ' '.join(filter(None, [
+        color(_name(instance)),
+        instance.instance_type,
+        instance.state_name,
+        instance.instance_id,
+        instance.image_id,
+        ('spot' if instance.spot_instance_request_id else 'ondemand'),
+        (instance.public_dns_name or '<no-ip>' if ip else None),
+        ','.join(instance.security_group_names),
+        ' '.join('%s=%s' % (k, v)
+                 for k, v in sorted(instance.tags.items(), key=lambda x: x[0])
+                 if (all_tags or k not in ['Name', 'creation-date', 'owner', 'launch', 'aws:ec2spot:fleet-request-id'])
+                 and v),
+    ]))
 
 
 def _name(instance):
@@ -195,7 +443,8 @@ def id(*tags, first_n=None, last_n=None):
 def subnet(*tags, first_n=None, last_n=None):
     vals = _ls(tags, 'running', first_n, last_n)
     vals = sorted(vals, key=lambda x: x.instance_id)
-    vals = [' '.join([util.colors.green(_name(i)), i.instance_id, _name(i.subnet), i.subnet.id, i.subnet.availability_zone]) for i in vals]
+    subnets = {id: _resource().Subnet(id) for id in {i.subnet_id for i in vals}}
+    vals = [' '.join([util.colors.green(_name(i)), i.instance_id, _name(subnets[i.subnet_id]), i.subnet_id, subnets[i.subnet_id].availability_zone]) for i in vals]
     if not vals:
         sys.exit(1)
     else:
@@ -242,17 +491,59 @@ def ipv4_private(*tags, first_n=None, last_n=None):
         return vals
 
 
-def ls(*tags, state='all', first_n=None, last_n=None, all_tags=False):
-    xs = _ls(tags, state, first_n, last_n)
-    xs = list(map(lambda y: _pretty(y, all_tags=all_tags), xs))
+def ls(*tags, state='all', first_n=None, last_n=None, all_tags=False, all_regions: 'query every region concurrently' = False):
+    if all_regions:
+        xs = ['%s %s' % (region, x)
+              for region, ys in _map_regions(lambda: ls(*tags, state=state, first_n=first_n, last_n=last_n, all_tags=all_tags))
+              for x in ys]
+    else:
+        xs = _ls(tags, state, first_n, last_n)
+        xs = list(map(lambda y: _pretty(y, all_tags=all_tags), xs))
     if not xs:
         sys.exit(1)
     else:
         return xs
 
 
-def _remote_cmd(cmd, stdin, instance_id):
-    return 'fail_msg="failed to run cmd on instance: %s"; mkdir -p ~/.cmds || echo $fail_msg; path=~/.cmds/$(uuidgen); input=$path.input; echo %s | base64 -d > $path || echo $fail_msg; echo %s | base64 -d > $input || echo $fail_msg; cat $input | bash $path; code=$?; if [ $code != 0 ]; then echo $fail_msg; exit $code; fi' % (instance_id, util.strings.b64_encode(cmd), util.strings.b64_encode(stdin)) # noqa
+def _remote_cmd(cmd, stdin, instance_id, args=''):
+    # with a tty stdin is the terminal, so the cmd and its stdin have to travel in argv
+    return 'fail_msg="failed to run cmd on instance: %s"; mkdir -p ~/.cmds || echo $fail_msg; path=~/.cmds/$(uuidgen); input=$path.input; echo %s | base64 -d > $path || echo $fail_msg; echo %s | base64 -d > $input || echo $fail_msg; cat $input | bash $path %s; code=$?; if [ $code != 0 ]; then echo $fail_msg; exit $code; fi' % (instance_id, util.strings.b64_encode(cmd), util.strings.b64_encode(stdin), args) # noqa
+
+
+_cmd_cache_lock = threading.Lock()
+_cmd_cache = set() # (instance_id, sha1) of cmds already uploaded to ~/.cmds on that instance
+_cmd_cache_miss = 'py-aws: cmd missing from the remote cache, uploading again:'
+_cmd_cache_miss_code = 222
+
+
+def _cached_remote_cmd(cmd, instance_id, args=''):
+    """
+    without a tty, cmds are cached on each instance at ~/.cmds/<sha1>.
+    the first time an instance sees a cmd it is sent over the ssh
+    channel ahead of stdin, after that only its hash is sent in argv.
+    the rest of the channel is the cmd's stdin, so stdin has no size
+    limit. returns the remote cmd, the bytes to send before stdin, and
+    the sha1.
+    """
+    data = cmd.encode()
+    sha = hashlib.sha1(data).hexdigest()
+    with _cmd_cache_lock:
+        cached = (instance_id, sha) in _cmd_cache
+    if cached:
+        upload = '[ -f $path ] || { echo %s %s; exit %s; }' % (shlex.quote(_cmd_cache_miss), sha, _cmd_cache_miss_code)
+        data = b''
+    else:
+        upload = 'head -c %s > $path.$$ && mv $path.$$ $path || { echo $fail_msg; exit 1; }' % len(data)
+    remote = 'fail_msg="failed to run cmd on instance: %s"; mkdir -p ~/.cmds || echo $fail_msg; path=~/.cmds/%s; %s; bash $path %s; code=$?; if [ $code != 0 ]; then echo $fail_msg; exit $code; fi' % (instance_id, sha, upload, args) # noqa
+    return remote, data, sha
+
+
+def _cmd_cache_update(instance_id, sha, cached):
+    with _cmd_cache_lock:
+        if cached:
+            _cmd_cache.add((instance_id, sha))
+        else:
+            _cmd_cache.discard((instance_id, sha))
 
 
 def ssh(
@@ -260,12 +551,13 @@ def ssh(
         first_n=None,
         last_n=None,
         stdin: 'stdin value to be provided to remote cmd' = '',
+        cmd_args: 'space separated args for cmd. cmds are cached on each instance by hash, so the same cmd with different args is only uploaded once' = '',
         quiet: 'less output' = False,
         no_stream: 'dont stream to stderr, only output to stdout' = False,
         stream_only: 'dont accumulate output for stdout, only stream to stderr' = False,
         cmd: 'cmd to run on remote host, can also be a file which will be read' ='',
         yes: 'no prompt to proceed' = False,
-        max_threads: 'max ssh connections' = 20,
+        max_threads: 'max ssh connections' = _max_threads,
         timeout: 'seconds before ssh cmd considered failed' = None,
         no_tty: 'when backgrounding a process, you dont want a tty' = False,
         key: 'speficy ssh key' = None,
@@ -298,12 +590,20 @@ def ssh(
     if not (quiet and yes):
         for i in instances:
             logging.info(_pretty(i))
-    ssh_cmd = ('ssh' + (' -i {} '.format(key) if key else '') + (' -tt ' if not no_tty or not cmd else ' -T ') + ssh_args).split()
+    ssh_cmd = ('ssh' + (' -i {} '.format(key) if key else '') + (' -tt ' if not no_tty or not cmd else ' -T ') + _ssh_args()).split()
     if echo:
         logging.info('ec2.ssh running against tags: %s, with cmd: %s', tags, cmd)
     if timeout:
         ssh_cmd = ['timeout', '{}s'.format(timeout)] + ssh_cmd
-    make_ssh_cmd = lambda instance: ssh_cmd + [_ssh_user(instance) + '@' + instance.public_dns_name, _remote_cmd(cmd, stdin, instance.instance_id)]
+    tty = not no_tty or not cmd
+    if not isinstance(cmd_args, str):
+        cmd_args = ' '.join(shlex.quote(str(arg)) for arg in cmd_args)
+    def make_ssh_cmd(instance):
+        target = _ssh_user(instance) + '@' + instance.public_dns_name
+        if tty:
+            return ssh_cmd + [target, _remote_cmd(cmd, stdin, instance.instance_id, cmd_args)], None, None
+        remote, data, sha = _cached_remote_cmd(cmd, instance.instance_id, cmd_args)
+        return ssh_cmd + [target, remote], data + (stdin if isinstance(stdin, bytes) else stdin.encode()), sha
     if is_cli and not yes and not (len(instances) == 1 and not cmd):
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
@@ -311,33 +611,30 @@ def ssh(
         if cmd and len(instances) > 1 or batch_mode:
             failures = []
             successes = []
-            results = None if stream_only else []
-            def run(instance):
-                def fn():
-                    try:
-                        shell.run(*make_ssh_cmd(instance),
-                                  callback=_make_callback(instance, quiet, results, no_stream),
-                                  stream_only=stream_only,
-                                  echo=False,
-                                  raw_cmd=True,
-                                  stream=False,
-                                  hide_stderr=quiet)
-                    except:
-                        if error_message:
-                            print(error_message.format(id=instance.instance_id,
-                                                       ip=instance.public_dns_name,
-                                                       ipv4_private=instance.private_ip_address,
-                                                       name=_name(instance)),
-                                  flush=True)
-                        msg = util.colors.red('failure: ') + _name(instance) + ': ' + instance.instance_id
-                        failures.append(msg)
-                    else:
-                        msg = util.colors.green('success: ') + _name(instance) + ': ' + instance.instance_id
-                        successes.append(msg)
+            def stream(instance, data):
+                if not no_stream:
+                    text = data.decode('utf-8', 'replace').replace('\r', '')
                     if not quiet:
-                        logging.info(msg)
-                return fn
-            pool.thread.wait(*map(run, instances), max_threads=max_threads)
+                        prefix = _name(instance) + ': ' + instance.public_dns_name + ': '
+                        text = '\n'.join(prefix + line for line in text.split('\n'))
+                    print(text, file=sys.stderr, flush=True)
+            def done(instance, code, seconds):
+                timing = ' (exit %s, %.1fs)' % (code, seconds)
+                if code:
+                    if error_message:
+                        print(error_message.format(id=instance.instance_id,
+                                                   ip=instance.public_dns_name,
+                                                   ipv4_private=instance.private_ip_address,
+                                                   name=_name(instance)),
+                              flush=True)
+                    msg = util.colors.red('failure: ') + _name(instance) + ': ' + instance.instance_id + timing
+                    failures.append(msg)
+                else:
+                    msg = util.colors.green('success: ') + _name(instance) + ': ' + instance.instance_id + timing
+                    successes.append(msg)
+                if not quiet:
+                    logging.info(msg)
+            results = _ssh_fanout(instances, make_ssh_cmd, max_threads, stream, done, hide_stderr=quiet)
             # TODO would be really nice to see these results, plus unknowns:, when ^C to exit early
             if not quiet:
                 logging.info('\nresults:')
@@ -346,11 +643,27 @@ def ssh(
                 logging.info('\ntotals:')
                 logging.info(util.colors.green(' successes: ') + str(len(successes)))
                 logging.info(util.colors.red(' failures: ') + str(len(failures)))
-            for result in results:
-                print(result)
+            if not stream_only:
+                for instance, (_, stdout, _) in zip(instances, results):
+                    prefix = '' if quiet else _name(instance) + ': ' + instance.public_dns_name + ': '
+                    for line in stdout.decode('utf-8', 'replace').replace('\r', '').splitlines():
+                        print(prefix + line)
             assert not failures
+        elif cmd and not tty:
+            prefix = _name(instances[0]) + ': ' + instances[0].public_dns_name + ': '
+            def stream(instance, data):
+                if not no_stream:
+                    text = data.decode('utf-8', 'replace').replace('\r', '')
+                    if prefixed:
+                        text = '\n'.join(prefix + line for line in text.split('\n'))
+                    print(text, file=sys.stderr, flush=True)
+            [(code, stdout, _)] = _ssh_fanout(instances, make_ssh_cmd, 1, stream, lambda *_: None, hide_stderr=quiet)
+            if code:
+                raise subprocess.CalledProcessError(code, 'ssh %s' % instances[0].instance_id, output=stdout)
+            if not stream_only:
+                return stdout.decode('utf-8', 'replace').rstrip()
         elif cmd:
-            return shell.run(*make_ssh_cmd(instances[0]),
+            return shell.run(*make_ssh_cmd(instances[0])[0],
                              echo=False,
                              stream=not prefixed and not no_stream,
                              stream_only=stream_only,
@@ -363,6 +676,156 @@ def ssh(
         raise
 
 
+class _PidfdChildWatcher(getattr(asyncio, 'AbstractChildWatcher', object)):
+    """
+    before python 3.12, asyncio waits on each subprocess with a thread of
+    its own, which is a thread per host in a fan-out. this waits on their
+    pidfds from the event loop which started them instead, so it can be
+    shared by the event loops of many threads at once, unlike
+    asyncio.PidfdChildWatcher, which is tied to one loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._children = {} # pid -> (loop, pidfd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def is_active(self):
+        return True
+
+    def attach_loop(self, loop):
+        pass
+
+    def close(self):
+        pass
+
+    def add_child_handler(self, pid, callback, *args):
+        loop = asyncio.get_running_loop()
+        pidfd = os.pidfd_open(pid)
+        with self._lock:
+            self._children[pid] = loop, pidfd
+        loop._add_reader(pidfd, self._wait, pid, callback, args)
+
+    def remove_child_handler(self, pid):
+        with self._lock:
+            child = self._children.pop(pid, None)
+        if child:
+            loop, pidfd = child
+            loop._remove_reader(pidfd)
+            os.close(pidfd)
+        return child is not None
+
+    def _wait(self, pid, callback, args):
+        self.remove_child_handler(pid)
+        try:
+            _, status = os.waitpid(pid, 0)
+        except ChildProcessError:
+            code = 255
+        else:
+            code = os.waitstatus_to_exitcode(status)
+        callback(pid, code, *args)
+
+
+_child_watcher_lock = threading.Lock()
+_child_watcher_installed = []
+
+
+def _install_child_watcher():
+    # python 3.12 and later already wait on pidfds where the kernel has them
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
+    with _child_watcher_lock:
+        if not _child_watcher_installed:
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+            except OSError:
+                pass # kernel older than 5.3, so keep the default watcher
+            else:
+                asyncio.set_child_watcher(_PidfdChildWatcher())
+            _child_watcher_installed.append(True)
+
+
+async def _ssh_proc(instance, cmd, data, stream, hide_stderr):
+    proc = await asyncio.create_subprocess_exec(*cmd,
+                                                stdin=subprocess.DEVNULL if data is None else subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.DEVNULL if hide_stderr else subprocess.PIPE)
+    stdout = bytearray()
+    async def read(pipe, buffer):
+        pending = b''
+        while True:
+            chunk = await pipe.read(1024 * 64)
+            if not chunk:
+                break
+            if buffer is not None:
+                buffer += chunk
+            head, newline, pending = (pending + chunk).rpartition(b'\n')
+            if newline:
+                stream(instance, head)
+        if pending:
+            stream(instance, pending)
+    async def write():
+        try:
+            proc.stdin.write(data)
+            await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the remote exited without reading all of stdin
+    tasks = [read(proc.stdout, stdout)]
+    if not hide_stderr:
+        tasks.append(read(proc.stderr, None))
+    if data is not None:
+        tasks.append(write())
+    await asyncio.gather(*tasks)
+    return await proc.wait(), bytes(stdout)
+
+
+async def _ssh_host(instance, make_cmd, semaphore, stream, done, hide_stderr):
+    async with semaphore:
+        start = time.time()
+        for _ in range(2):
+            cmd, data, sha = make_cmd(instance)
+            code, stdout = await _ssh_proc(instance, cmd, data, stream, hide_stderr)
+            if not sha:
+                break
+            if code == _cmd_cache_miss_code and stdout.startswith(_cmd_cache_miss.encode()):
+                _cmd_cache_update(instance.instance_id, sha, False)
+                continue
+            if code != 255: # 255 is ssh itself failing, so the upload may not have happened
+                _cmd_cache_update(instance.instance_id, sha, True)
+            break
+        seconds = time.time() - start
+        done(instance, code, seconds)
+        return code, stdout, seconds
+
+
+def _ssh_fanout(instances, make_cmd, max_concurrency, stream, done, hide_stderr=False):
+    """
+    run one ssh subprocess per instance from a single event loop, with
+    at most $max_concurrency running at once. make_cmd(instance) returns
+    (argv, bytes for stdin or None, sha1 of a cached remote cmd or None). output is read in chunks
+    into a byte buffer per host. stream(instance, bytes) is called with
+    complete lines as they arrive, and done(instance, exit_code, seconds)
+    as each host finishes. returns [(exit_code, stdout, seconds), ...]
+    in the same order as instances.
+    """
+    async def main():
+        semaphore = asyncio.Semaphore(max_concurrency or len(instances))
+        return await asyncio.gather(*[_ssh_host(instance, make_cmd, semaphore, stream, done, hide_stderr)
+                                      for instance in instances])
+    _install_child_watcher()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
 def _make_callback(instance, quiet, append=None, no_stream=False):
     name = _name(instance) + ': ' + instance.public_dns_name + ': '
     def f(x):
@@ -374,11 +837,92 @@ def _make_callback(instance, quiet, append=None, no_stream=False):
     return f
 
 
-def scp(src, dst, *tags, yes=False, max_threads=0, first_n=None, last_n=None):
+def _scp_remote_path(path):
+    # ssh starts in the home dir, so ~ and relative paths resolve there without a shell expanding them
+    if path in ['', '~']:
+        return '.'
+    elif path.startswith('~/'):
+        return path[2:] or '.'
+    assert not path.startswith('~'), 'with --chunks, remote paths cannot start with ~user: %s' % path
+    return path
+
+
+def _scp_chunked(instance, user, src, dst, chunks):
+    """
+    copy one large file as byte ranges over parallel ssh connections,
+    writing each range in place, then compare the sha256 of each range
+    on both ends and copy again any which differ. returns bytes copied.
+    """
+    # each range needs its own tcp connection, so skip the multiplexed master. ssh
+    # takes the first value it sees for an option, so the override goes in front.
+    argv = ['ssh', '-o', 'ControlMaster=no', '-o', 'ControlPath=none'] + shlex.split(_ssh_args()) + ['%s@%s' % (user, instance.public_dns_name)]
+    def remote(cmd):
+        return subprocess.check_output(argv + [cmd]).decode().strip()
+    upload = dst.startswith(':')
+    if upload:
+        local = src
+        size = os.path.getsize(local)
+        # resolve a directory to a path inside it, and preallocate so ranges can be written in place
+        path = remote('p=%s; [ -d "$p" ] && p="$p"/%s; truncate -s %d "$p" && echo "$p"' % (shlex.quote(_scp_remote_path(dst[1:])), shlex.quote(os.path.basename(local)), size))
+    else:
+        path = _scp_remote_path(src[1:])
+        local = os.path.join(dst, os.path.basename(path)) if os.path.isdir(dst) else dst
+        size = remote('[ -f %(path)s ] && stat -c %%s %(path)s || true' % {'path': shlex.quote(path)})
+        assert size, 'with --chunks, src must be a single file on the instance: %s' % src
+        size = int(size)
+        open(local, 'a').close()
+        os.truncate(local, size)
+    path = shlex.quote(path)
+    step = max(1, -(-size // chunks))
+    ranges = [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+    def copy(offset, length):
+        with open(local, 'rb' if upload else 'r+b') as f:
+            f.seek(offset)
+            if upload:
+                proc = subprocess.Popen(argv + ['dd of=%s bs=1M oflag=seek_bytes seek=%d conv=notrunc status=none' % (path, offset)], stdin=subprocess.PIPE)
+                remaining = length
+                while remaining:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    assert chunk, '%s changed size while copying' % local
+                    proc.stdin.write(chunk)
+                    remaining -= len(chunk)
+                proc.stdin.close()
+            else:
+                proc = subprocess.Popen(argv + ['dd if=%s bs=1M iflag=skip_bytes,count_bytes skip=%d count=%d status=none' % (path, offset, length)], stdout=subprocess.PIPE)
+                for chunk in iter(lambda: proc.stdout.read(1024 * 1024), b''):
+                    f.write(chunk)
+            assert proc.wait() == 0, 'failed to copy bytes %s-%s of %s' % (offset, offset + length, local)
+    def verify(offset, length):
+        sha = hashlib.sha256()
+        with open(local, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                sha.update(chunk)
+                remaining -= len(chunk)
+        return sha.hexdigest() == remote('dd if=%s bs=1M iflag=skip_bytes,count_bytes skip=%d count=%d status=none | sha256sum' % (path, offset, length)).split()[0]
+    for _ in range(3):
+        list(pool.thread.map(lambda x: copy(*x), ranges))
+        ranges = [x for x, ok in zip(ranges, list(pool.thread.map(lambda x: verify(*x), ranges))) if not ok]
+        if not ranges:
+            return size
+        logging.info('%s: %s ranges failed sha256 verification, copying them again', instance.public_dns_name, len(ranges))
+    assert False, 'sha256 verification failed for %s ranges of %s' % (len(ranges), local)
+
+
+def scp(src, dst, *tags, yes=False, max_threads=0, first_n=None, last_n=None,
+        chunks: 'for one large file, split it into this many byte ranges copied over parallel ssh connections and verified with sha256' = 0):
     assert tags, 'you must specify some tags'
     assert ':' in src + dst, 'you didnt specify a remote path, which starts with ":"'
     instances = _ls(tags, 'running', first_n=first_n, last_n=last_n)
     assert instances, 'didnt find instances:\n%s' % ('\n'.join(_pretty(i) for i in instances) or '<nothing>')
+    if chunks:
+        assert src.startswith(':') != dst.startswith(':'), 'with --chunks, exactly one of src and dst must be remote'
+        assert dst.startswith(':') or len(instances) == 1, 'with --chunks, you can only download from one instance'
+        assert src.startswith(':') or os.path.isfile(src), 'with --chunks, src must be a single file'
     user = _ssh_user(*instances)
     logging.info('targeting:')
     for instance in instances:
@@ -399,7 +943,13 @@ def scp(src, dst, *tags, yes=False, max_threads=0, first_n=None, last_n=None):
             _src = host + src if src.startswith(':') else src
             _dst = host + dst if dst.startswith(':') else dst
             try:
-                shell.run('scp', ssh_args, _src, _dst, callback=lambda x: print(color(name + x), flush=True))
+                if chunks:
+                    start = time.time()
+                    size = _scp_chunked(instance, user, src, dst, chunks)
+                    elapsed = max(time.time() - start, 1e-3)
+                    print(color(name + '%.1f MB in %.1fs, %.1f MB/s' % (size / 1e6, elapsed, size / 1e6 / elapsed)), flush=True)
+                else:
+                    shell.run('scp', _ssh_args(), _src, _dst, callback=lambda x: print(color(name + x), flush=True))
             except:
                 failures.append(util.colors.red('failure: ') + instance.public_dns_name)
             else:
@@ -415,43 +965,197 @@ def scp(src, dst, *tags, yes=False, max_threads=0, first_n=None, last_n=None):
         sys.exit(1)
 
 
+_compressors = {'gzip': ('gzip -c', 'gzip -dc'),
+                'lz4': ('lz4 -c', 'lz4 -dc'),
+                'zstd': ('zstd -q -c -T0', 'zstd -q -dc')}
+
+
+def _push_files(src, name):
+    # the same files as _tar_script(), relative to the parent of src
+    return shell.run('cd %s && src=$(pwd) && cd $(dirname $src) &&' % src, _find_files(name)).splitlines()
+
+
+def _push_matches(path, top, name):
+    # whether a manifest path is one which _find_files() would list
+    return path.split('/')[0] == top and (not name or fnmatch.fnmatchcase(os.path.basename(path), name))
+
+
+def _push_manifest(src, name):
+    """
+    {path: sha1} of every file push would send. hashes are memoized by
+    size and mtime, so only files which changed are read again.
+    """
+    memo_path = os.path.expanduser('~/.cache/py-aws/push/hashes.json')
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+    except (IOError, ValueError):
+        memo = {}
+    parent = os.path.dirname(os.path.abspath(src))
+    manifest = {}
+    for path in _push_files(src, name):
+        abspath = os.path.join(parent, path)
+        if not os.path.exists(abspath): # broken symlink
+            continue
+        stat = os.stat(abspath)
+        key = [stat.st_size, stat.st_mtime_ns]
+        if memo.get(abspath, [])[:2] != key:
+            sha = hashlib.sha1()
+            with open(abspath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+            memo[abspath] = key + [sha.hexdigest()]
+        manifest[path] = memo[abspath][2]
+    os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+    with open(memo_path, 'w') as f:
+        json.dump(memo, f)
+    return manifest
+
+
+def _push_manifest_path(instance, dst):
+    return os.path.expanduser('~/.cache/py-aws/push/%s.%s.json' % (instance.instance_id, hashlib.sha1(dst.encode()).hexdigest()))
+
+
+def _push_remote_manifest(instance, dst, top, name, verify):
+    """
+    {path: sha1} of what is under dst on an instance. this is the
+    manifest cached after the last sync to it, or with verify, the
+    result of hashing the files on the instance which match name.
+    """
+    if verify:
+        out = ssh(instance,
+                  cmd='cd %s 2>/dev/null && src=%s && %s | tr "\\n" "\\0" | xargs -0 -r sha1sum || true' % (dst, shlex.quote(top), _find_files(name)),
+                  no_tty=True, yes=True, quiet=True, no_stream=True)
+        return {path: sha for sha, path in (line.split('  ', 1) for line in out.splitlines() if '  ' in line)}
+    try:
+        with open(_push_manifest_path(instance, dst)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
 # TODO when one instance only, dont colorize
 # TODO stop using bash -s
-def push(src, dst, *tags, first_n=None, last_n=None, name=None, yes=False, max_threads=0):
+def push(src, dst, *tags, first_n=None, last_n=None, name=None, yes=False, max_threads=0,
+         compress: 'compress the archive with gzip, lz4 or zstd, which must be installed locally and on the instances' = None,
+         broadcast: (
+             'send the archive from here to one instance per round, while every '
+             'instance which already has it forwards it to another over private '
+             'ips with ssh agent forwarding. your uplink carries it about log2(n) '
+             'times instead of n times.') = False,
+         sync: (
+             'only send files whose content changed since the last sync to each '
+             'instance, based on a manifest of hashes per instance cached in '
+             '~/.cache/py-aws/push') = False,
+         verify: 'with --sync, hash the files on each instance instead of trusting the cached manifest' = False,
+         delete: 'with --sync, delete files on the instances which no longer exist locally' = False):
     assert tags, 'you must specify some tags'
+    assert not compress or compress in _compressors, 'compress must be one of: %s' % ', '.join(sorted(_compressors))
+    assert not (sync and broadcast), '--sync sends different files to each instance, so it cannot --broadcast'
+    assert sync or not (verify or delete), '--verify and --delete only make sense with --sync'
     instances = _ls(tags, 'running', first_n, last_n)
     assert instances, 'didnt find instances:\n%s' % ('\n'.join(_pretty(i) for i in instances) or '<nothing>')
     user = _ssh_user(*instances)
     logging.info('targeting:')
     for instance in instances:
         logging.info(' %s', _pretty(instance))
-    logging.info('going to push:\n%s', util.strings.indent(shell.run('bash', _tar_script(src, name, echo_only=True)), 1))
+    if sync:
+        # group instances by the files they need, so each distinct archive is built once
+        local = _push_manifest(src, name)
+        top = os.path.basename(os.path.abspath(src))
+        remotes = dict(zip(instances, pool.thread.map(lambda instance: _push_remote_manifest(instance, dst, top, name, verify), instances)))
+        groups = collections.defaultdict(list)
+        removals = {}
+        for instance in instances:
+            remote = remotes[instance]
+            changed = tuple(sorted(path for path, sha in local.items() if remote.get(path) != sha))
+            # only files which this push would have sent can be stale, anything outside of name is left alone
+            removals[instance] = sorted(path for path in remote if path not in local and _push_matches(path, top, name))
+            groups[changed].append(instance)
+        logging.info('going to sync:')
+        for changed, xs in sorted(groups.items()):
+            logging.info(' %s changed files to %s instances%s', len(changed), len(xs), ''.join('\n  ' + path for path in changed))
+        if delete:
+            logging.info(' %s files to delete', sum(map(len, removals.values())))
+    else:
+        logging.info('going to push:\n%s', util.strings.indent(shell.run('bash', _tar_script(src, name, echo_only=True)), 1))
     if is_cli and not yes:
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
+    # each archive is built once, and every instance which needs it gets the same bytes
     script = _tar_script(src, name)
+    tmp = os.path.dirname(script)
+    compressor = _compressors[compress][0] if compress else 'cat'
+    bundles = {}
+    if sync:
+        for i, changed in enumerate(groups):
+            if changed:
+                with open(os.path.join(tmp, 'files.%s' % i), 'w') as f:
+                    f.write('\n'.join(changed) + '\n')
+                bundles[changed] = os.path.join(tmp, 'bundle.%s' % i)
+                shell.run('tar cfh - -C', os.path.dirname(os.path.abspath(src)), '-T', f.name, '|', compressor, '>', bundles[changed])
+    else:
+        bundles[None] = os.path.join(tmp, 'bundle')
+        shell.run('bash', script, '2>/dev/null |', compressor, '>', bundles[None])
+        logging.info('archive: %s bytes', os.path.getsize(bundles[None]))
+    unpack = ('%s | tar xf -' % _compressors[compress][1]) if compress else 'tar xf -'
+    remote_bundle = '/tmp/py-aws-push.%s' % uuid.uuid4().hex
+    if broadcast:
+        # keep a copy on each instance, so it can be forwarded
+        receive = 'cat > %(remote_bundle)s.$$ && mv %(remote_bundle)s.$$ %(remote_bundle)s && mkdir -p %(dst)s && cd %(dst)s && cat %(remote_bundle)s | %(unpack)s' % locals()
+    else:
+        receive = 'mkdir -p %(dst)s && cd %(dst)s && %(unpack)s' % locals()
     failures = []
     successes = []
+    received = []
     justify = max(len(i.public_dns_name) for i in instances)
-    def run(instance, color):
-        if color:
-            color = getattr(util.colors, color)
-        else:
-            color = lambda x: x
+    colors = dict(zip(instances, itertools.cycle(util.colors._colors) if len(instances) > 1 else []))
+    def run(sender, instance, bundle=bundles.get(None)):
+        color = getattr(util.colors, colors[instance]) if instance in colors else lambda x: x
         name = (instance.public_dns_name + ': ').ljust(justify + 2)
+        if sender is None:
+            cmd = 'cat %s | ssh %s %s@%s %s' % (bundle, _ssh_args(), user, instance.public_dns_name, shlex.quote(receive))
+        else:
+            # agent forwarding needs its own connection, so skip the multiplexed master
+            forward = 'cat %s | ssh %s %s@%s %s' % (remote_bundle, ssh_args, user, instance.private_ip_address, shlex.quote(receive))
+            cmd = 'ssh -A -o ControlMaster=no -o ControlPath=none %s %s@%s %s' % (ssh_args, user, sender.public_dns_name, shlex.quote(forward))
         def fn():
             try:
-                shell.run('bash', script,
-                          '|ssh', ssh_args, user + '@' + instance.public_dns_name,
-                          '"mkdir -p', dst, '&& cd', dst, '&& tar xf -"',
-                          callback=lambda x: print(color(name + x), flush=True))
+                if bundle:
+                    shell.run(cmd, callback=lambda x: print(color(name + x), flush=True))
+                if sync and delete and removals[instance]:
+                    ssh(instance, cmd='cd %s && xargs -0 rm -f --' % dst, stdin='\0'.join(removals[instance]), no_tty=True, yes=True, quiet=True)
             except:
                 failures.append(util.colors.red('failure: ') + instance.public_dns_name)
             else:
                 successes.append(util.colors.green('success: ') + instance.public_dns_name)
+                received.append(instance)
         return fn
-    pool.thread.wait(*map(run, instances, itertools.cycle(util.colors._colors) if len(instances) > 1 else [False]), max_threads=max_threads)
-    shell.check_call('rm -rf', os.path.dirname(script))
+    if broadcast:
+        # each round, here and every instance which has the archive sends it to one more
+        pending = list(instances)
+        while pending:
+            pairs = list(zip([None] + received, pending))
+            pending = pending[len(pairs):]
+            logging.info('broadcast round: %s senders', len(pairs))
+            pool.thread.wait(*[run(sender, instance) for sender, instance in pairs], max_threads=max_threads)
+        try:
+            ssh(*instances, cmd='rm -f %s' % remote_bundle, no_tty=True, yes=True, quiet=True, batch_mode=True, stream_only=True)
+        except:
+            logging.info('failed to clean up %s on some instances', remote_bundle)
+    elif sync:
+        pool.thread.wait(*[run(None, instance, bundles.get(changed)) for changed, xs in groups.items() for instance in xs], max_threads=max_threads)
+        for instance in received:
+            manifest = {path: sha for path, sha in remotes[instance].items() if not _push_matches(path, top, name)}
+            manifest.update(local)
+            if not delete:
+                manifest.update((path, remotes[instance][path]) for path in removals[instance])
+            os.makedirs(os.path.dirname(_push_manifest_path(instance, dst)), exist_ok=True)
+            with open(_push_manifest_path(instance, dst), 'w') as f:
+                json.dump(manifest, f)
+    else:
+        pool.thread.wait(*[run(None, instance) for instance in instances], max_threads=max_threads)
+    shell.check_call('rm -rf', tmp)
     logging.info('\nresults:')
     for msg in successes + failures:
         logging.info(' ' + msg)
@@ -460,41 +1164,81 @@ def push(src, dst, *tags, first_n=None, last_n=None, name=None, yes=False, max_t
 
 
 # TODO stop using bash -s
-def pull(src, dst, *tags, first_n=None, last_n=None, name=None, yes=False):
+def pull(src, dst, *tags, first_n=None, last_n=None, name=None, yes=False, max_threads=0,
+         compress: 'compress on the wire with gzip, lz4 or zstd, which must be installed locally and on the instances, or none' = 'gzip',
+         no_preview: 'skip the ssh pass which lists the files to be pulled' = False):
+    # with more than one instance, each is pulled into its own subdirectory of dst, named by instance id
     assert tags, 'you must specify some tags'
+    assert compress in _compressors or compress in ['none', None], 'compress must be one of: none, %s' % ', '.join(sorted(_compressors))
+    compress = None if compress == 'none' else compress
     instances = _ls(tags, 'running', first_n, last_n)
-    assert len(instances) == 1, 'didnt find exactly one instances:\n%s' % ('\n'.join(_pretty(i) for i in instances) or '<nothing>')
+    assert instances, 'didnt find instances:\n%s' % ('\n'.join(_pretty(i) for i in instances) or '<nothing>')
     user = _ssh_user(*instances)
-    instance = instances[0]
-    logging.info('targeting:\n %s', _pretty(instance))
-    host = instance.public_dns_name
-    script = _tar_script(src, name, echo_only=True)
-    cmd = ('cat %(script)s |ssh' + ssh_args + user + '@%(host)s bash -s') % locals()
-    logging.info('going to pull:')
-    logging.info(util.strings.indent(shell.check_output(cmd), 1))
-    shell.check_call('rm -rf', os.path.dirname(script))
+    logging.info('targeting:')
+    for instance in instances:
+        logging.info(' %s', _pretty(instance))
+    def dst_dir(instance):
+        return dst if len(instances) == 1 else os.path.join(dst, instance.instance_id)
+    if not no_preview:
+        script = _tar_script(src, name, echo_only=True)
+        def preview(instance):
+            cmd = 'cat %s | ssh %s %s@%s bash -s 2>&1' % (script, _ssh_args(), user, instance.public_dns_name)
+            try:
+                return shell.check_output(cmd).splitlines()
+            except:
+                return ['<failed to list files>']
+        listings = pool.thread.map(preview, instances)
+        shell.check_call('rm -rf', os.path.dirname(script))
+        logging.info('going to pull:')
+        if len(instances) == 1:
+            logging.info(util.strings.indent('\n'.join(listings[0]), 1))
+        else:
+            for instance, listing in zip(instances, listings):
+                logging.info(' %s files from %s into %s', len(listing), _pretty(instance), dst_dir(instance))
     if is_cli and not yes:
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
+    # compress on the instance and decompress as it streams into tar, so the downlink is the bottleneck
     script = _tar_script(src, name)
-    cmd = ('cd %(dst)s && cat %(script)s | ssh' + ssh_args + user + '@%(host)s bash -s | tar xf -') % locals()
+    remote = 'bash -s 2>/dev/null' + (' | %s' % _compressors[compress][0] if compress else '')
+    unpack = ('%s | tar xf -' % _compressors[compress][1]) if compress else 'tar xf -'
+    failures = []
+    successes = []
+    def run(instance):
+        def fn():
+            path = dst_dir(instance)
+            cmd = 'mkdir -p %s && cd %s && cat %s | ssh %s %s@%s %s | %s' % (path, path, script, _ssh_args(), user, instance.public_dns_name, shlex.quote(remote), unpack)
+            try:
+                shell.check_call('set -o pipefail &&', cmd)
+            except:
+                failures.append(util.colors.red('failure: ') + '%s %s' % (_name(instance), instance.public_dns_name))
+            else:
+                successes.append(util.colors.green('success: ') + '%s %s' % (_name(instance), instance.public_dns_name))
+        return fn
     try:
-        shell.check_call(cmd)
-    except:
-        logging.info('failure for: %s %s', _name(instance), instance.public_dns_name)
-        sys.exit(1)
+        pool.thread.wait(*map(run, instances), max_threads=max_threads)
     finally:
         shell.check_call('rm -rf', os.path.dirname(script))
+    logging.info('\nresults:')
+    for msg in successes + failures:
+        logging.info(' ' + msg)
+    if failures:
+        sys.exit(1)
+
+
+def _find_files(name):
+    # files under $src, relative to its parent, which push and pull send
+    name = ('-name %s' % shlex.quote(name)) if name else ''
+    return 'find -L $(basename $src) -type f %(name)s -o -type l %(name)s' % locals()
 
 
 def _tar_script(src, name, echo_only=False):
-    name = ('-name %s' % name) if name else ''
     script = ('cd %(src)s\n'
               'src=$(pwd)\n'
               'cd $(dirname $src)\n'
-              "FILES=$(find -L $(basename $src) -type f %(name)s -o -type l %(name)s)\n"
+              'FILES=$(%(find)s)\n'
               'echo $FILES|tr " " "\\n"|grep -v \.git 1>&2\n'
-              + ('' if echo_only else 'tar cfh - $FILES')) % locals()
+              + ('' if echo_only else 'tar cfh - $FILES')) % dict(src=src, find=_find_files(name))
     with shell.tempdir(cleanup=False):
         with open('script.sh', 'w') as f:
             f.write(script)
@@ -527,7 +1271,7 @@ def mosh(*tags, first_n=None, last_n=None):
 
 def stop(*tags, yes=False, first_n=None, last_n=None, wait=False):
     assert tags, 'you cannot stop all things, specify some tags'
-    instances = _ls(tags, ['running', 'stopped'], first_n, last_n)
+    instances = _ls(tags, ['running', 'stopped'], first_n, last_n, cache=False)
     assert instances, 'didnt find any running instances for those tags'
     logging.info('going to stop the following instances:')
     for i in instances:
@@ -536,6 +1280,7 @@ def stop(*tags, yes=False, first_n=None, last_n=None, wait=False):
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
     _retry(_client().stop_instances)(InstanceIds=[i.instance_id for i in instances])
+    _invalidate_inventory()
     if wait:
         logging.info('waiting for all to stop')
         _wait_for_state('stopped', *instances)
@@ -544,13 +1289,13 @@ def stop(*tags, yes=False, first_n=None, last_n=None, wait=False):
 def rm(*tags, yes=False, first_n=None, last_n=None):
     assert tags, 'you cannot rm all things, specify some tags'
     assert tags != ('*',), 'you cannot rm all things'
-    pendings = _ls(tags, 'pending', first_n, last_n)
+    pendings = _ls(tags, 'pending', first_n, last_n, cache=False)
     if pendings:
         logging.info('wait for pending instances before rm:')
         for pending in pendings:
             logging.info(' %s', _pretty(pending))
         _wait_for_state('running', *pendings)
-    instances = _ls(tags, ['running', 'stopped'], first_n, last_n)
+    instances = _ls(tags, ['running', 'stopped'], first_n, last_n, cache=False)
     assert instances, 'didnt find any instances for those tags'
     logging.info('going to terminate the following instances:')
     for i in instances:
@@ -559,6 +1304,7 @@ def rm(*tags, yes=False, first_n=None, last_n=None):
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
     _retry(_client().terminate_instances)(InstanceIds=[i.instance_id for i in instances])
+    _invalidate_inventory()
 
 
 def _ls_by_ids(*ids):
@@ -570,7 +1316,7 @@ def _wait_for_state(state, *instances_or_instance_ids):
     ids = [getattr(i, 'instance_id', i) for i in instances_or_instance_ids]
     for i in range(300):
         try:
-            new_instances = _ls(ids, state=state)
+            new_instances = _ls(ids, state=state, cache=False)
             assert len(ids) == len(new_instances), '%s != %s' % (len(ids), (new_instances))
             return new_instances
         except:
@@ -601,43 +1347,187 @@ def _ssh_user(*instances):
     return users.pop()
 
 
+_ssh_wait_seconds = 30 * 60 # give up waiting for ssh after this long, unless a shorter --seconds-wait was given
+
+
+async def _probe_ssh(instance, timeout=10):
+    """
+    a tcp connect to port 22 gates the much more expensive ssh handshake.
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(instance.public_dns_name, 22), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    cmd = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%s' % timeout] + _ssh_args().split() + [_ssh_user(instance) + '@' + instance.public_dns_name, 'true']
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return await asyncio.wait_for(proc.wait(), timeout) == 0
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return False
+
+
+async def _probe_ssh_until_ready(instance):
+    while not await _probe_ssh(instance):
+        await asyncio.sleep(1)
+    return instance.instance_id
+
+
+async def _ssh_ready(instance_ids, seconds):
+    """
+    yield instance ids as they become ssh-able, for up to $seconds. all
+    instances are probed concurrently, so this waits on the slowest
+    instance, not on rounds of probes.
+    """
+    loop = asyncio.get_event_loop()
+    ls = _in_region(lambda ids: _ls(ids, state='running', cache=False))
+    waiting = set(instance_ids)
+    probes = {}
+    start = time.time()
+    try:
+        while waiting and time.time() - start < seconds:
+            unknown = waiting - set(probes)
+            if unknown: # wait for running instances to have a public dns name before probing them
+                for instance in await loop.run_in_executor(None, ls, sorted(unknown)):
+                    if instance.public_dns_name:
+                        probes[instance.instance_id] = asyncio.ensure_future(_probe_ssh_until_ready(instance))
+            if probes:
+                done, _ = await asyncio.wait(list(probes.values()), timeout=5, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    instance_id = task.result()
+                    waiting.remove(instance_id)
+                    del probes[instance_id]
+                    yield instance_id
+            else:
+                await asyncio.sleep(5)
+    finally:
+        for task in probes.values():
+            task.cancel()
+
+
+async def _ssh_ready_as_completed(launch, num, seconds):
+    """
+    launch(n) units of capacity, and yield ids as they become ssh-able,
+    until num units are ready. launch yields (instance id, weight) as
+    instances are created, and each is probed right away. an instance which dies, or is not ssh-able within $seconds
+    of being created, is terminated and replaced while the rest keep
+    starting. gives up after 5 launches.
+    """
+    loop = asyncio.get_event_loop()
+    ls = _in_region(lambda ids: _ls(ids, state='all', cache=False))
+    def terminate(ids):
+        try:
+            rm(*ids, yes=True)
+        except AssertionError:
+            pass # already terminated
+    terminate = _in_region(terminate)
+    launched = {} # instance id -> creation time, for instances which are not ready yet
+    weights = {} # instance id -> units of capacity
+    launching = {} # future -> [requested, created] units
+    probes = {}
+    stopped = []
+    def arrived(request, instance_id, weight):
+        request[1] += weight
+        launched[instance_id] = time.time()
+        weights[instance_id] = weight
+    def start(request):
+        instance_ids = launch(request[0])
+        try:
+            for instance_id, weight in instance_ids:
+                try:
+                    assert not stopped
+                    loop.call_soon_threadsafe(arrived, request, instance_id, weight)
+                except (AssertionError, RuntimeError): # stopped early, so nobody will use this
+                    terminate([instance_id])
+                    break
+        finally:
+            instance_ids.close()
+    start = _in_region(start)
+    ready = 0
+    tries = 0
+    try:
+        while ready < num:
+            for future in [x for x in launching if x.done()]:
+                del launching[future]
+                if future.exception():
+                    logging.error('failed to create instances, retrying...', exc_info=future.exception())
+            missing = num - ready - sum(weights[x] for x in launched) - sum(max(0, requested - created) for requested, created in launching.values())
+            if missing > 0:
+                assert tries < 5, 'failed to spinup and then wait for ssh on instances after 5 tries. aborting.'
+                tries += 1
+                request = [missing, 0]
+                launching[loop.run_in_executor(None, start, request)] = request
+            lost = [x for x in launched if time.time() - launched[x] > seconds]
+            unknown = [x for x in launched if x not in probes and x not in lost]
+            if unknown: # wait for running instances to have a public dns name before probing them
+                for instance in await loop.run_in_executor(None, ls, unknown):
+                    if instance.state_name in ['shutting-down', 'terminated', 'stopping', 'stopped']:
+                        lost.append(instance.instance_id)
+                    elif instance.state_name == 'running' and instance.public_dns_name:
+                        probes[instance.instance_id] = asyncio.ensure_future(_probe_ssh_until_ready(instance))
+            if lost:
+                logging.info('replacing %s instances which died or were not ssh-able within %s seconds: %s', len(lost), seconds, ' '.join(lost))
+                for instance_id in lost:
+                    del launched[instance_id]
+                    if instance_id in probes:
+                        probes.pop(instance_id).cancel()
+                await loop.run_in_executor(None, terminate, lost)
+            elif probes:
+                done, _ = await asyncio.wait(list(probes.values()), timeout=5, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    instance_id = task.result()
+                    del probes[instance_id]
+                    del launched[instance_id]
+                    ready += weights[instance_id]
+                    yield instance_id
+            else:
+                await asyncio.sleep(5)
+    finally:
+        stopped.append(True)
+        for task in probes.values():
+            task.cancel()
+        if launched: # stopped early, so nobody will use these
+            terminate(list(launched))
+
+
+def _iter_async(agen):
+    """
+    iterate an async generator from sync code, on a private event loop
+    """
+    _install_child_watcher()
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
+
 def _wait_for_ssh(*instances, seconds=0):
     logging.info('wait for ssh...')
-    true_start = time.time()
-    for _ in range(200):
-        running = _ls([i.instance_id for i in instances], state='running')
-        start = time.time()
-        try:
-            running_ids = ' '.join([i.instance_id for i in running])
-            res = shell.run('ec2 ssh', running_ids,  '--batch-mode -t 10 -yc "whoami>/dev/null" 2>&1', warn=True)
-            ready_ids = [x.split()[-1]
-                         for x in res['stdout'].splitlines()
-                         if x.startswith('success: ')]
-            num_ready = len(ready_ids)
-            num_not_ready = len(instances) - num_ready
-            logging.info('waiting for %s nodes', num_not_ready)
-            if seconds and time.time() - true_start > seconds and num_not_ready:
-                logging.info('waited for %s seconds, %s ready, %s not ready and will be terminated', seconds, num_ready, num_not_ready)
-                not_ready_ids = [i.instance_id
-                                 for i in instances
-                                 if i.instance_id not in set(ready_ids)]
-                if not_ready_ids:
-                    rm(*not_ready_ids, yes=True)
-                num_not_ready = 0
-            if num_not_ready == 0:
-                if ready_ids:
-                    return ready_ids
-                else:
-                    break # fail
-        except KeyboardInterrupt:
-            raise
-        time.sleep(max(0, 5 - (time.time() - start)))
-    assert False, 'failed to wait for ssh'
+    ids = [i.instance_id for i in instances]
+    ready_ids = []
+    for instance_id in _iter_async(_ssh_ready(ids, seconds or _ssh_wait_seconds)):
+        ready_ids.append(instance_id)
+        logging.info('ssh ready: %s, waiting for %s nodes', instance_id, len(ids) - len(ready_ids))
+    not_ready_ids = [x for x in ids if x not in set(ready_ids)]
+    if not_ready_ids:
+        assert seconds, 'failed to wait for ssh'
+        logging.info('waited for %s seconds, %s ready, %s not ready and will be terminated', seconds, len(ready_ids), len(not_ready_ids))
+        rm(*not_ready_ids, yes=True)
+    assert ready_ids, 'failed to wait for ssh'
+    return ready_ids
 
 
 def untag(ls_tags, unset_tags, yes=False, first_n=None, last_n=None):
     assert '=' not in unset_tags, 'no "=", just the name of the tag to unset'
-    instances = _ls(tuple(ls_tags.split(',')), 'all', first_n, last_n)
+    instances = _ls(tuple(ls_tags.split(',')), 'all', first_n, last_n, cache=False)
     assert instances, 'didnt find any instances for those tags'
     logging.info('going to untag the following instances:')
     for i in instances:
@@ -650,12 +1540,13 @@ def untag(ls_tags, unset_tags, yes=False, first_n=None, last_n=None):
         assert pager.getch() == 'y', 'abort'
     for i in instances:
         for t in unset_tags.split(','):
-            _retry(i.create_tags)(Tags=[{'Key': t, 'Value': ''}])[0].delete()
+            _retry(_client().delete_tags)(Resources=[i.instance_id], Tags=[{'Key': t}])
             logging.info('untagged: %s', _pretty(i))
+    _invalidate_inventory()
 
 
 def tag(ls_tags, set_tags, yes=False, first_n=None, last_n=None):
-    instances = _ls(tuple(ls_tags.split(',')), 'all', first_n, last_n)
+    instances = _ls(tuple(ls_tags.split(',')), 'all', first_n, last_n, cache=False)
     assert instances, 'didnt find any instances for those tags'
     logging.info('going to tag the following instances:')
     for i in instances:
@@ -670,6 +1561,7 @@ def tag(ls_tags, set_tags, yes=False, first_n=None, last_n=None):
         Resources=[i.instance_id for i in instances],
         Tags=[{'Key': k, 'Value': v} for t in set_tags.split(',') for k, v in [t.split('=')]]
     )
+    _invalidate_inventory()
 
 
 def wait(*tags, state='running', yes=False, first_n=None, last_n=None, ssh=False):
@@ -905,7 +1797,7 @@ def amis_all(id_only=False):
         return [x for x in xs if x]
 
 
-def amis(name, *tags, id_only=False, most_recent=False):
+def _amis(name, *tags, most_recent=False):
     assert len(tags) in [0, 1], 'only one tag currently supported'
     if tags:
         tag_filter = [{'Name': 'tag:' + tags[0].split('=')[0], 'Values': [tags[0].split('=')[1]]}]
@@ -917,22 +1809,32 @@ def amis(name, *tags, id_only=False, most_recent=False):
                                               {'Name': 'state',
                                                'Values': ['available']}] + tag_filter)
     amis = [x for x in amis if x.name.split('__')[0] == name]
-    if not amis:
-        logging.info('no amis matched name: %s %s', name, tags[0] if tags else '')
-        sys.exit(1)
     amis = sorted(amis, key=lambda x: x.creation_date, reverse=True)
     if most_recent:
         amis = amis[:1]
+    return amis
+
+
+def amis(name, *tags, id_only=False, most_recent=False, all_regions: 'query every region concurrently' = False):
+    if all_regions:
+        amis = [(region, ami)
+                for region, xs in _map_regions(lambda: _amis(name, *tags, most_recent=most_recent))
+                for ami in xs]
+    else:
+        amis = [(None, ami) for ami in _amis(name, *tags, most_recent=most_recent)]
+    if not amis:
+        logging.info('no amis matched name: %s %s', name, tags[0] if tags else '')
+        sys.exit(1)
     if id_only:
-        return [ami.image_id for ami in amis]
+        return [' '.join(filter(None, [region, ami.image_id])) for region, ami in amis]
     else:
-        def f(ami):
+        def f(region, ami):
             name, date = ami.name.split('__')
             description = ami.description if ami.description != name else '-'
             tag = '%(Key)s=%(Value)s' % ami.tags[0] if ami.tags else '-'
-            return ' '.join([ami.image_id, date, description, tag])
-        logging.info('id date description tag')
-        return [f(ami) for ami in amis]
+            return ' '.join(filter(None, [region, ami.image_id, date, description, tag]))
+        logging.info('%sid date description tag', 'region ' if all_regions else '')
+        return [f(region, ami) for region, ami in amis]
 
 
 # TODO something better
@@ -992,14 +1894,15 @@ def vpc_id(name_contains):
 
 
 def _subnet(vpc, zone):
+    return _subnets(vpc, zone)[0].id
+
+
+def _subnets(vpc, zone):
     vpcs = list(_resource().vpcs.filter(Filters=[{'Name': 'vpc-id' if vpc.startswith('vpc-') else 'tag:Name', 'Values': [vpc]}]))
     assert len(vpcs) == 1, 'no vpc named: %s' % vpc
-    if zone:
-        subnets = [x for x in vpcs[0].subnets.all() if x.availability_zone == zone]
-    else:
-        subnets = list(vpcs[0].subnets.all())[:1]
-    assert len(subnets) == 1, 'no subnet for vpc=%(vpc)s zone=%(zone)s' % locals()
-    return subnets[0].id
+    subnets = [x for x in vpcs[0].subnets.all() if not zone or x.availability_zone == zone]
+    assert subnets, 'no subnets for vpc=%(vpc)s zone=%(zone)s' % locals()
+    return subnets
 
 
 def _blocks(gigs, gigs_st1=None, naming='sda'):
@@ -1027,54 +1930,100 @@ def _tear_down_spot_instances(request_id):
         rm(*xs, yes=True)
 
 
-# TODO have a max seconds before returning whatever came up and terminating the
-# rest, just like wait-for-ssh
-def _create_spot_instances(**opts):
-    request_id = _client().request_spot_fleet(SpotFleetRequestConfig=opts)['SpotFleetRequestId']
+_spot_wait_seconds = 10 * 60 # accept partial spot fleet fulfilment after this long
+
+
+def _create_spot_instances(spot_opts, seconds=_spot_wait_seconds):
+    """
+    request a spot fleet, and yield (instance id, instance type) as soon
+    as they are active, so ssh can be waited on while the rest are still
+    being fulfilled. polls quickly while instances keep arriving, and
+    backs off while they dont. after $seconds, the fleet is shrunk to
+    whatever capacity has been fulfilled and that is all you get.
+    """
+    request_id = _client().request_spot_fleet(SpotFleetRequestConfig=spot_opts)['SpotFleetRequestId']
     logging.info("wait for spot request to be filled for fleet:\n%s", request_id)
+    target = spot_opts['TargetCapacity']
+    weights = {x['InstanceType']: x.get('WeightedCapacity', 1) for x in spot_opts['LaunchSpecifications']}
+    failed_states = ['cancelled', 'failed', 'cancelled_running', 'cancelled_terminating']
+    seen = []
+    fulfilled = 0
+    start = time.time()
+    delay = 1
     try:
-        for _ in range(300):
+        while fulfilled < target:
             state = _retry(_client().describe_spot_fleet_requests)(SpotFleetRequestIds=[request_id])['SpotFleetRequestConfigs'][0]['SpotFleetRequestState']
-            failed_states = ['cancelled', 'failed', 'cancelled_running', 'cancelled_terminating']
             assert state not in failed_states, 'spot fleet failed with: %s' % state
             xs = _retry(_client().describe_spot_fleet_instances)(SpotFleetRequestId=request_id)['ActiveInstances']
-            if len(xs) == opts['TargetCapacity']:
+            xs = [x for x in xs if x.get('InstanceId') and x['InstanceId'] not in seen]
+            for x in xs:
+                seen.append(x['InstanceId'])
+                fulfilled += weights.get(x.get('InstanceType'), 1)
+                yield x['InstanceId'], x.get('InstanceType')
+            if fulfilled >= target:
+                break
+            # checked on every poll, so a fleet which trickles in still stops at the deadline
+            if time.time() - start > seconds:
+                assert seen, 'failed to wait for spot requests'
+                logging.info('accepting %s of %s spot capacity after %s seconds', fulfilled, target, seconds)
+                _retry(_client().modify_spot_fleet_request)(SpotFleetRequestId=request_id, TargetCapacity=fulfilled)
                 break
+            if xs:
+                delay = 1
+                time.sleep(delay)
             else:
-                current = len(xs)
-                logging.info('waiting for %s requests', opts['TargetCapacity'] - current)
-                time.sleep(4 + random.random())
-        else:
-            raise AssertionError('failed to wait for spot requests')
+                logging.info('waiting for %s requests', target - fulfilled)
+                time.sleep(delay + random.random())
+                delay = min(delay * 1.5, 15)
+    except GeneratorExit:
+        # the caller stopped early and owns what it was given, so only clean up the rest
+        _retry(_client().cancel_spot_fleet_requests)(SpotFleetRequestIds=[request_id], TerminateInstances=False)
+        xs = _retry(_client().describe_spot_fleet_instances)(SpotFleetRequestId=request_id)['ActiveInstances']
+        xs = [x.get('InstanceId') for x in xs]
+        xs = [x for x in xs if x and x not in seen]
+        if xs:
+            rm(*xs, yes=True)
+        raise
     except:
         _tear_down_spot_instances(request_id)
         raise
-    else:
-        instance_ids = [x['InstanceId'] for x in xs]
-        for _ in range(5):
-            instances = _ls(instance_ids, state='all')
-            if len(instances) == len(instance_ids):
-                return instances
-            time.sleep(5)
-        raise Exception('failed to get the right number of instances')
 
 
-def _make_spot_opts(spot, opts, fleet_role):
+def _parse_types(type):
+    """
+    "i3.large,i3.xlarge:2" -> [('i3.large', 1), ('i3.xlarge', 2)]. the weight
+    is how many units of --num one instance of that type counts as.
+    """
+    types = []
+    for x in (type.split(',') if isinstance(type, str) else type):
+        name, _, weight = x.strip().partition(':')
+        assert name, 'bad instance type: %s' % x
+        types.append((name, int(weight or 1)))
+    return types
+
+
+def _make_spot_opts(bids, opts, fleet_role, allocation):
+    """
+    bids are [(type, weight, max price per instance), ...]. each type gets
+    its own launch specification, across every subnet in opts['SubnetId'].
+    """
     if 'arn' not in fleet_role:
-        fleet_role = _retry(boto3.client('iam').get_role)(RoleName=fleet_role)['Role']['Arn']
+        fleet_role = _retry(_cached_client('iam').get_role)(RoleName=fleet_role)['Role']['Arn']
     spot_opts = {}
     spot_opts['Type'] = 'request'
     spot_opts['ReplaceUnhealthyInstances'] = False
     spot_opts['InstanceInterruptionBehavior'] = 'terminate'
     spot_opts['TerminateInstancesWithExpiration'] = False
-    spot_opts['SpotPrice'] = str(float(spot))
+    spot_opts['SpotPrice'] = str(max(price / weight for _, weight, price in bids)) # prices are per unit of capacity
+    spot_opts['AllocationStrategy'] = allocation
     spot_opts['IamFleetRole'] = fleet_role
     spot_opts['TargetCapacity'] = opts['MaxCount']
     opts['SecurityGroups'] = [{'GroupId': x} for x in opts['SecurityGroupIds']]
     opts = util.dicts.drop(opts, ['MaxCount', 'MinCount', 'SecurityGroupIds'])
     if 'UserData' in opts:
         opts['UserData'] = util.strings.b64_encode(opts['UserData'])
-    spot_opts['LaunchSpecifications'] = [opts]
+    spot_opts['LaunchSpecifications'] = [dict(opts, InstanceType=type, WeightedCapacity=weight, SpotPrice=str(price / weight))
+                                         for type, weight, price in bids]
     return spot_opts
 
 
@@ -1155,7 +2104,12 @@ def new(name: 'name of the instance',
         key: 'key pair name'                          = shell.conf.get_or_prompt_pref('key',  __file__, message='key pair name'),
         ami: 'ami id'                                 = shell.conf.get_or_prompt_pref('ami',  __file__, message='ami id'),
         sg: 'security group name'                     = shell.conf.get_or_prompt_pref('sg',   __file__, message='security group name'),
-        type: 'instance type'                         = shell.conf.get_or_prompt_pref('type', __file__, message='instance type'),
+        type: (
+            'instance type. for spot, a comma '
+            'separated list of acceptable types, '
+            'each with an optional ":<weight>" for '
+            'how many units of --num it counts as, '
+            'like "i3.large,i3.xlarge:2"')             = shell.conf.get_or_prompt_pref('type', __file__, message='instance type'),
         vpc: 'vpc name'                               = shell.conf.get_or_prompt_pref('vpc',  __file__, message='vpc name'),
         subnet: 'subnet id'                           = None,
         role: 'ec2 instance iam role'                 = None,
@@ -1167,6 +2121,9 @@ def new(name: 'name of the instance',
         cmd: 'ssh command'                            = None,
         num: 'number of instances'                    = 1,
         spot_days: 'num days for spot price check'    = 2,
+        allocation: (
+            'spot fleet allocation strategy, '
+            'capacityOptimized or lowestPrice')       = 'capacityOptimized',
         tty:   'run cmd in a tty'                     = False,
         no_wait: 'do not wait for ssh'                = False,
         login: 'login in to the instance'             = False,
@@ -1195,16 +2152,26 @@ def new(name: 'name of the instance',
             'set to 0 to disable.')                   = shell.conf.get_optional_pref('seconds-timeout', __file__, 0),
         seconds_wait: (
             'how many seconds to wait for ssh '
-            'before continuing with however '
-            'many instances became available '
-            'and terminating the rest')               = 0):
-    if spot:
-        spot_percentage = spot
-        ondemand_price = list(prices(type))[0]
-        spot = float(spot) * ondemand_price
-        logging.info('bidding spot at: (spot * on-demand) %s * %s = %s', spot_percentage, ondemand_price, spot)
+            'on each instance before terminating '
+            'and replacing it. instances which '
+            'die while starting are replaced '
+            'right away.')                            = 0,
+        stream: (
+            'print instance ids as they become '
+            'ssh-able. from python, return a '
+            'generator of them instead of a list.')   = False):
+    # returns the instance ids once all are ssh-able, or with stream, yields
+    # them as they become ssh-able, so the first ones can be used while the
+    # rest are still starting. failed or slow instances are replaced one by
+    # one, instead of terminating everything and starting over.
+    types = _parse_types(type)
+    type = types[0][0]
+    assert spot or types == [(type, 1)], 'multiple or weighted types only work with --spot'
+    assert allocation in ['capacityOptimized', 'lowestPrice'], 'allocation must be capacityOptimized or lowestPrice'
+    assert len({x.startswith('i3.') for x, _ in types}) == 1, 'cannot mix i3 and other types, since i3 needs its nvme disk setup by init'
+    assert len({x.split('.')[0] in ['t1', 'm1'] for x, _ in types}) == 1, 'cannot mix pv and hvm types, since they need different amis'
     num = int(num)
-    assert not (spot and type == 't2.nano'), 'no spot pricing for t2.nano'
+    assert not (spot and 't2.nano' in dict(types)), 'no spot pricing for t2.nano'
     assert not login or num == 1, util.colors.red('you asked to login, but you are starting more than one instance, so its not gonna happen')
     owner = shell.run('whoami')
     for tag in tags:
@@ -1259,75 +2226,84 @@ def new(name: 'name of the instance',
                                                                                  for k, v in [tag.split('=')]]}]
     if role:
         opts['IamInstanceProfile'] = {'Name': role}
-    # TODO something like this, but a generator. when spinning up lots of
-    # instances, returns them as they become available, retrying failed
-    # ones and returning those later. excepts if is ultimately unable to
-    # spin up everybody.
-    # TODO is this like a threadpool of ec2? with an as_completed iterator?
-    # TODO do a more surgical retry. dont rm all and start over. keep
-    # the good ones, and start over for only as many new ones as we
-    # need to fulfill the originally requested number.
-    if spot and zone is None:
-        zone, _, = cheapest_zone(type, days=spot_days)
-    for _ in range(5):
-        assert vpc or subnet, 'need to provide a --vpc or --subnet'
-        if subnet is not None:
-            opts['SubnetId'] = subnet
-        else:
-            opts['SubnetId'] = _subnet(vpc, zone)
-        logging.info('using vpc: %s', vpc)
+    assert vpc or subnet, 'need to provide a --vpc or --subnet'
+    if subnet is not None:
+        subnets = [_resource().Subnet(subnet)]
+    elif spot:
+        subnets = _subnets(vpc, zone) # let the fleet fill from every zone, unless --zone
+    else:
+        subnets = [_resource().Subnet(_subnet(vpc, zone))]
+    opts['SubnetId'] = ','.join(x.id for x in subnets)
+    logging.info('using vpc: %s', vpc)
+    if spot:
+        zones = {x.availability_zone for x in subnets}
+        bids = []
+        for x, weight, unit_price in _rank_spot_types(types, zones, spot_days):
+            ondemand_price = list(prices(x))[0]
+            bid = float(spot) * ondemand_price
+            logging.info('%s: max spot price per unit %s, bidding (spot * on-demand) %s * %s = %s', x, unit_price, spot, ondemand_price, bid)
+            bids.append((x, weight, bid))
+        assert bids, 'no spot prices for types: %s' % ', '.join(x for x, _ in types)
+    def launch(n):
+        # yields (instance id, weight) as instances are created, which for spot can take a while
+        # a copy per launch, since replacements can launch while an earlier launch is still filling
+        launch_opts = dict(opts, MinCount=n, MaxCount=n)
         if spot:
-            spot_opts = _make_spot_opts(spot, opts, fleet_role)
+            spot_opts = _make_spot_opts(bids, launch_opts, fleet_role, allocation)
             _spot_opts = copy.deepcopy(spot_opts)
-            _spot_opts['LaunchSpecifications'][0].pop('UserData', None)
+            for x in _spot_opts['LaunchSpecifications']:
+                x.pop('UserData', None)
             logging.info('request spot instances:\n' + pprint.pformat(_spot_opts))
-            # TODO improve the wait-for-spot-fullfillment logic inside _create_spot_instances()
-            # TODO currently this can error, which is not so good. compared to _resource().create_instances().
-            try:
-                instances = _create_spot_instances(**spot_opts)
-            except KeyboardInterrupt:
-                raise
-            except:
-                logging.exception('failed to create spot instances, retrying...')
-                continue
+            instances = _create_spot_instances(spot_opts)
         else:
-            logging.info('create instances:\n' + pprint.pformat(util.dicts.drop(opts, ['UserData'])))
-            instances = _resource().create_instances(**opts)
+            logging.info('create instances:\n' + pprint.pformat(util.dicts.drop(launch_opts, ['UserData'])))
+            instances = [(i.instance_id, type) for i in _resource().create_instances(**launch_opts)]
+        for instance_id, instance_type in instances:
+            _invalidate_inventory()
+            logging.info('instance: %s %s', instance_id, instance_type)
+            yield instance_id, dict(types).get(instance_type, 1)
+    if cmd and os.path.exists(cmd):
+        logging.info('reading cmd from: %s', os.path.abspath(cmd))
+        with open(cmd) as f:
+            cmd = f.read()
+    def ready():
         if no_wait:
-            logging.info('instances:')
-            return [i.instance_id for i in instances]
-        else:
-            logging.info('instances:\n%s', '\n'.join([i.instance_id for i in instances]))
-            try:
-                ready_ids = _wait_for_ssh(*instances, seconds=seconds_wait)
-                break
-            except KeyboardInterrupt:
+            for _ in range(5):
                 try:
-                    rm(*[i.instance_id for i in instances], yes=True)
-                except AssertionError:
-                    pass # when $seconds, and no instances where ready, everything has already been terminated, and rm fails an assert
-                raise
+                    instance_ids = [instance_id for instance_id, _ in launch(num)]
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    logging.exception('failed to create instances, retrying...')
+                else:
+                    yield from instance_ids
+                    return
+            assert False, 'failed to create instances after 5 tries. aborting.'
+        # cmd starts on each instance as soon as it is ready, not after all of them are
+        failures = []
+        def run(instance_id):
+            try:
+                ssh(instance_id, yes=True, cmd=cmd, no_tty=not tty, prefixed=True, stream_only=True)
             except:
-                try:
-                    rm(*[i.instance_id for i in instances], yes=True)
-                except AssertionError:
-                    pass # when $seconds, and no instances where ready, everything has already been terminated, and rm fails an assert
-                logging.exception('failed to spinup and then wait for ssh on instances, retrying...')
-    else:
-        assert False, 'failed to spinup and then wait for ssh on instances after 5 tries. aborting.'
-    ready_instances = _ls(ready_ids, state='running')
-    if login:
-        logging.info('logging in...')
-        ssh(ready_instances[0].instance_id, yes=True, quiet=True)
-    elif cmd:
-        if os.path.exists(cmd):
-            logging.info('reading cmd from: %s', os.path.abspath(cmd))
-            with open(cmd) as f:
-                cmd = f.read()
-        logging.info('running cmd...')
-        ssh(*[i.instance_id for i in ready_instances], yes=True, cmd=cmd, no_tty=not tty)
-    logging.info('done')
-    return [i.instance_id for i in ready_instances]
+                failures.append(instance_id)
+        threads = []
+        ready_ids = []
+        logging.info('wait for ssh...')
+        for instance_id in _iter_async(_ssh_ready_as_completed(launch, num, seconds_wait or _ssh_wait_seconds)):
+            ready_ids.append(instance_id)
+            logging.info('ssh ready: %s, %s nodes ready', instance_id, len(ready_ids))
+            if cmd and not login:
+                threads.append(threading.Thread(target=_in_region(run), args=(instance_id,)))
+                threads[-1].start()
+            yield instance_id
+        for thread in threads:
+            thread.join()
+        if login:
+            logging.info('logging in...')
+            ssh(ready_ids[0], yes=True, quiet=True)
+        assert not failures, 'cmd failed on: %s' % ' '.join(failures)
+        logging.info('done')
+    return ready() if stream else list(ready())
 
 
 # TODO this can probably be cached for some time period
@@ -1459,9 +2435,27 @@ def cheapest_zone(type, days=7):
     return [zone, price]
 
 
+def _rank_spot_types(types, zones, days=7):
+    """
+    [(type, weight, price per unit), ...] cheapest first, by the max spot
+    price over $days in any of zones. types with no spot prices in those
+    zones are dropped.
+    """
+    def fn(x):
+        type, weight = x
+        return [float(p['price']) for p in _spot_price_history(type, days) if p['zone'] in zones]
+    ranked = []
+    for (type, weight), history in zip(types, pool.thread.map(_in_region(fn), types)):
+        if history:
+            ranked.append((type, weight, max(history) / weight))
+        else:
+            logging.info('no spot prices for %s in zones: %s', type, ' '.join(sorted(zones)))
+    return sorted(ranked, key=lambda x: x[2])
+
+
 def start(*tags, yes=False, first_n=None, last_n=None, login=False, wait=False):
     assert tags, 'you cannot start all things, specify some tags'
-    instances = _ls(tags, 'stopped', first_n, last_n)
+    instances = _ls(tags, 'stopped', first_n, last_n, cache=False)
     assert instances, 'didnt find any stopped instances for those tags'
     logging.info('going to start the following instances:')
     for i in instances:
@@ -1470,17 +2464,17 @@ def start(*tags, yes=False, first_n=None, last_n=None, login=False, wait=False):
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
     _retry(_client().start_instances)(InstanceIds=[i.instance_id for i in instances])
+    _invalidate_inventory()
     if login:
         assert len(instances) == 1, util.colors.red('you asked to ssh, but you started more than one instance, so its not gonna happen')
-        instances[0].wait_until_running()
+        _wait_for_state('running', instances[0])
         try:
-            shell.check_call('ssh' + ssh_args + '%s@%s' % (_ssh_user(instances[0]), _wait_for_ssh(*instances)[0]), echo=True)
+            shell.check_call('ssh' + _ssh_args() + '%s@%s' % (_ssh_user(instances[0]), _wait_for_ssh(*instances)[0]), echo=True)
         except:
             sys.exit(1)
     elif wait:
         logging.info('waiting for all to start')
-        for i in instances:
-            i.wait_until_running()
+        _wait_for_state('running', *instances)
 
 
 def ami(*tags, yes=False, first_n=None, last_n=None, no_wait=False, name=None, description=None, no_append_date=False, tag=None):
@@ -1491,18 +2485,19 @@ def ami(*tags, yes=False, first_n=None, last_n=None, no_wait=False, name=None, d
     if not no_append_date:
         name += '__' + str(datetime.datetime.utcnow()).replace(' ', 'T').split('.')[0].replace(':', '-') + 'Z'
     assert tags, 'you must specify some tags'
-    instances = _ls(tags, ['running', 'stopped'], first_n, last_n)
+    instances = _ls(tags, ['running', 'stopped'], first_n, last_n, cache=False)
     assert len(instances) == 1, 'didnt find exactly one instance:\n%s' % ('\n'.join(_pretty(i) for i in instances) or '<nothing>')
     instance = instances[0]
-    if instance.state['Name'] == 'running':
+    if instance.state_name == 'running':
         logging.info('going to image the following instance:')
         logging.info(' ' + _pretty(instance))
         if is_cli and not yes:
             logging.info('\nwould you like to proceed? y/n\n')
             assert pager.getch() == 'y', 'abort'
-        instance.stop()
+        _retry(_client().stop_instances)(InstanceIds=[instance.instance_id])
+        _invalidate_inventory()
         _wait_for_state('stopped', instance)
-    image = instance.create_image(Name=name, Description=description)
+    image = _resource().Instance(instance.instance_id).create_image(Name=name, Description=description)
     if tag:
         key, value = tag.split('=')
         image.create_tags(Tags=[{'Key': key, 'Value': value}])
@@ -1515,7 +2510,13 @@ def ami(*tags, yes=False, first_n=None, last_n=None, no_wait=False, name=None, d
     return ami_id
 
 
-def spot_fleets(*ids):
+def spot_fleets(*ids, all_regions: 'query every region concurrently' = False):
+    if all_regions:
+        xs = ['%s %s' % (region, x)
+              for region, ys in _map_regions(lambda: spot_fleets(*ids))
+              for x in ys]
+        yield from sorted(xs, key=lambda x: x.split()[1], reverse=True)
+        return
     resp = _client().describe_spot_fleet_requests()
     for fleet in sorted(resp['SpotFleetRequestConfigs'], key=lambda x: x['CreateTime'], reverse=True):
         yield ' '.join(map(str, [
@@ -1551,7 +2552,7 @@ def user_data(*tags, first_n=None, last_n=None, yes=False):
     if is_cli and not yes:
         logging.info('\nwould you like to proceed? y/n\n')
         assert pager.getch() == 'y', 'abort'
-    hashbang, *data = util.strings.b64_decode(instance.describe_attribute(InstanceId=instance.instance_id, Attribute='userData')['UserData']['Value']).splitlines()
+    hashbang, *data = util.strings.b64_decode(_client().describe_instance_attribute(InstanceId=instance.instance_id, Attribute='userData')['UserData']['Value']).splitlines()
     logging.info('type: %s', hashbang)
     return '\n'.join(data)
 
@@ -1586,7 +2587,7 @@ def snapshot(*tags, first_n=None, last_n=None, yes=False):
     now = _now()
     for instance in instances:
         volumes = [x
-                   for x in instance.volumes.all()
+                   for x in _resource().Instance(instance.instance_id).volumes.all()
                    if ['/dev/sda1'] == [y['Device'] for y in x.attachments]]
         assert len(volumes) == 1, 'more than 1 volume, not sure what to snapshot'
         volume = volumes[0]
@@ -1663,11 +2664,11 @@ def num_volumes(*tags, first_n=None, last_n=None, yes=False):
     instances = _ls(tags, 'running', first_n=first_n, last_n=last_n)
     assert instances, 'didnt find any instance:\n%s' % ('\n'.join(_pretty(i) for i in instances) or '<nothing>')
     for instance in instances:
-        print(len(list(instance.volumes.all())), _pretty(instance))
+        print(len(list(_resource().Instance(instance.instance_id).volumes.all())), _pretty(instance))
 
 
 def roles():
-    client = boto3.client('iam')
+    client = _cached_client('iam')
     for role in client.list_roles()['Roles']:
         if role['AssumeRolePolicyDocument']['Statement'] == [{'Action': 'sts:AssumeRole', 'Effect': 'Allow', 'Principal': {'Service': 'ec2.amazonaws.com'}}]:
             print(role['RoleName'])
@@ -1756,82 +2757,815 @@ def _stdin_file(arg_num, cmd):
     return 'stdin.%(cmd_hash)s.%(arg_num)s' % locals()
 
 
-def _cmd(cmd, arg_num, worker_num):
-    _cmd = cmd.format(worker_num=worker_num)
-    stdout = _stdout_file(arg_num, cmd)
-    stderr = _stderr_file(arg_num, cmd)
-    stdin = _stdin_file(arg_num, cmd)
-    cmd_hash = stdin.split('.')[1]
-    return 'set +e; cat - > %(stdin)s; echo "%(cmd_hash)s: %(cmd)s" >> cmds.log; (echo "cat %(stdin)s | (%(_cmd)s)" 1>&2; cat %(stdin)s | (%(_cmd)s); echo exited: $? 1>&2;) > %(stdout)s 2> %(stderr)s </dev/null &' % locals()
+def _exit_file(arg_num, cmd):
+    cmd_hash = hashlib.sha1(bytes(cmd, 'utf-8')).hexdigest()
+    return 'nohup.%(cmd_hash)s.%(arg_num)s.exit' % locals()
+
+
+def _pid_file(arg_num, cmd):
+    cmd_hash = hashlib.sha1(bytes(cmd, 'utf-8')).hexdigest()
+    return 'nohup.%(cmd_hash)s.%(arg_num)s.pid' % locals()
+
+
+def _cmd(cmd, worker_num, slot_num=0, **fields):
+    """
+    a script which starts a batch of args in the background, one after
+    another. the arg_nums are its positional args, and stdin is a line
+    of "<arg_num> <base64 arg>" per arg. each arg gets its own stdin,
+    stdout, stderr and exit files, so results and retries stay per arg
+    even when many small args share one job. the script itself does not
+    depend on the args, so each instance caches it once per slot. fields
+    fill in any other {names} in cmd, in the same single format.
+    """
+    _cmd = cmd.format(worker_num=worker_num, slot_num=slot_num, **fields)
+    stdout = _stdout_file('$n', cmd)
+    stderr = _stderr_file('$n', cmd)
+    stdin = _stdin_file('$n', cmd)
+    exit = _exit_file('$n', cmd)
+    pid = _pid_file('$1', cmd)
+    batch = _stdin_file('$1', cmd) + '.batch'
+    cmd_hash = batch.split('.')[1]
+    # set -m puts the job in its own process group, so _kill_cmd() can take down everything it started
+    return ('set +e; set -m; for n in "$@"; do rm -f %(exit)s; done; rm -f %(pid)s; cat - > %(batch)s; echo "%(cmd_hash)s: %(cmd)s" >> cmds.log; '
+            '(while read n arg; do echo $arg | base64 -d > %(stdin)s; '
+            '(start=$(date +%%s%%N); echo "cat %(stdin)s | (%(_cmd)s)" 1>&2; cat %(stdin)s | (%(_cmd)s); code=$?; echo exited: $code 1>&2; echo $code $(( ($(date +%%s%%N) - start) / 1000000 )) > %(exit)s.tmp; mv %(exit)s.tmp %(exit)s) > %(stdout)s 2> %(stderr)s </dev/null; '
+            'done < %(batch)s) </dev/null >/dev/null 2>&1 & echo $! > %(pid)s') % locals()
+
+
+def _watch_cmd(cmd):
+    """
+    block on the remote host until a batch started by _cmd() exits, then
+    print a line per arg of "<arg_num> <exit code> <runtime millis>
+    <base64 stdout>". the wait happens on the remote host, so there are
+    no round trips until the batch is done. an arg which never exited,
+    because its batch is not running anymore, is printed as "<arg_num> lost".
+    takes the same positional args as _cmd().
+    """
+    exit = _exit_file('$n', cmd)
+    stdout = _stdout_file('$n', cmd)
+    pid = _pid_file('$1', cmd)
+    return ('exited() { for n in "$@"; do [ -f %(exit)s ] || return 1; done; }; '
+            'while ! exited "$@" && kill -0 $(cat %(pid)s 2>/dev/null) 2>/dev/null; do sleep .1; done; '
+            'for n in "$@"; do if [ -f %(exit)s ]; then echo $n $(cat %(exit)s) $(base64 -w0 %(stdout)s); else echo $n lost; fi; done') % locals()
+
+
+_pmap_silent_seconds = 5 * 60 # ask ec2 about an instance whose watchers have been quiet this long
+_pmap_silent_check_seconds = 60
+
+
+def _pmap_start(instance, cmd, batch, worker_num, slot_num, **fields):
+    # not retried here, callers decide what a failure means for the instance
+    ssh(
+        instance,
+        cmd=_cmd(cmd, worker_num, slot_num, **fields),
+        cmd_args=[arg_num for arg_num, _ in batch],
+        no_tty=True,
+        yes=True,
+        quiet=True,
+        stdin=''.join('%s %s\n' % (arg_num, base64.b64encode(arg.encode()).decode()) for arg_num, arg in batch))
+
+
+def _pmap_watch(instance, cmd, batch):
+    """
+    block until a batch started by _pmap_start() exits, and return
+    {arg_num: (exit_code, stdout, runtime_seconds)}. args which never
+    exited have an exit code of "lost".
+    """
+    res = _retry(ssh)(
+        instance,
+        cmd=_watch_cmd(cmd),
+        cmd_args=[arg_num for arg_num, _ in batch],
+        no_tty=True,
+        quiet=True,
+        no_stream=True,
+        yes=True,
+    )
+    results = {}
+    for line in res.splitlines():
+        if line.strip():
+            arg_num, code, *rest = line.split()
+            if code == 'lost':
+                results[int(arg_num)] = (code, None, None)
+            else:
+                try:
+                    millis, stdout = (rest + [''])[:2]
+                    results[int(arg_num)] = (code, base64.b64decode(stdout).decode('utf-8', 'replace').rstrip('\n'), int(millis) / 1000)
+                except ValueError: # a garbled result is a problem with the job, not the instance
+                    logging.info('failed to parse result: arg_num: %s, instance: %s', arg_num, instance.instance_id)
+                    results[int(arg_num)] = ('lost', None, None)
+    return results
+
+
+def _kill_cmd(cmd):
+    pid = _pid_file('$1', cmd)
+    return 'kill -TERM -- -$(cat %(pid)s) 2>/dev/null; true' % locals()
+
+
+def _pmap_journal_path(session):
+    return os.path.expanduser('~/.cache/py-aws/pmap.%s.sqlite' % session)
+
+
+def _pmap_journal(session):
+    """
+    a sqlite journal of the state of every arg in a pmap session, so
+    that a pmap whose driver died can pick up where it left off.
+    """
+    path = _pmap_journal_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute('pragma journal_mode = wal')
+    db.execute('pragma synchronous = normal')
+    db.execute('create table if not exists meta (key text primary key, value text)')
+    db.execute('create table if not exists args (arg_num integer primary key, arg text, state text, instance_id text, slot_num integer, retries integer, result text)')
+    db.commit()
+    return db, path
 
 
-# TODO should print an eta based on rate of args and total args
-def pmap(instance_ids: 'comma separated ec2 instance ids to run cmds on',
-         args: 'comma separated strings which will be supplied as stdin to cmd',
-         cmd: '{worker_num} can be used as a unique integer id per worker',
+def _vcpus(*instance_types):
+    resp = _retry(_client().describe_instance_types)(InstanceTypes=sorted(set(instance_types)))
+    return {x['InstanceType']: x['VCpuInfo']['DefaultVCpus'] for x in resp['InstanceTypes']}
+
+
+class _PmapStats:
+    """
+    throughput and latency counters for a pmap, rendered as a status
+    line while it runs and exported as json when it is done. latency
+    is measured from starting a job to hearing that it exited, and the
+    part of that not spent in the job itself is ssh and scheduling
+    overhead.
+    """
+
+    window = 60 # seconds of completions the rolling rate is based on
+
+    def __init__(self, done=0):
+        self.start_time = time.time()
+        self.done = done
+        self.done_here = 0
+        self.retries = 0
+        self.speculated = 0
+        self.completed = collections.deque()
+        self.started = {}
+        self.latency = collections.defaultdict(collections.Counter)
+        self.timed = 0
+        self.wall = 0.0
+        self.runtime = 0.0
+        self.last_render = 0
+
+    def start(self, arg_num):
+        self.started[arg_num] = time.time()
+
+    def finish(self, arg_num, instance_id, ok, runtime=None):
+        now = time.time()
+        if ok:
+            self.done += 1
+            self.done_here += 1
+            self.completed.append(now)
+        else:
+            self.retries += 1
+        started = self.started.pop(arg_num, None)
+        if started is not None: # adopted jobs have no start time
+            wall = now - started
+            bucket = 1
+            while bucket < wall:
+                bucket *= 2
+            self.latency[instance_id]['<=%ss' % bucket] += 1
+            if runtime is not None:
+                self.timed += 1
+                self.wall += wall
+                self.runtime += runtime
+
+    def stats(self, remaining, queued, running, idle):
+        now = time.time()
+        while self.completed and self.completed[0] < now - self.window:
+            self.completed.popleft()
+        elapsed = now - self.start_time
+        rolling = len(self.completed) / max(1e-9, min(self.window, elapsed))
+        return {'elapsed_seconds': round(elapsed, 1),
+                'done': self.done,
+                'remaining': remaining,
+                'args_per_second_rolling': round(rolling, 2),
+                'args_per_second_total': round(self.done_here / max(1e-9, elapsed), 2),
+                'eta_seconds': round(remaining / rolling) if remaining is not None and rolling else None,
+                'queued': queued,
+                'running': running,
+                'idle_slots': idle,
+                'retries': self.retries,
+                'speculated': self.speculated,
+                'mean_runtime_seconds': round(self.runtime / self.timed, 3) if self.timed else None,
+                'mean_ssh_overhead_seconds': round((self.wall - self.runtime) / self.timed, 3) if self.timed else None,
+                'latency_histogram': {k: dict(v) for k, v in sorted(self.latency.items())}}
+
+    def render(self, stats):
+        eta = stats['eta_seconds']
+        return 'pmap: %s done, %s remaining, %s/s (%s/s total), eta %s, queued %s, running %s, idle %s, retries %s, speculated %s, runtime %ss, overhead %ss' % (
+            stats['done'],
+            '?' if stats['remaining'] is None else stats['remaining'],
+            stats['args_per_second_rolling'],
+            stats['args_per_second_total'],
+            '?' if eta is None else '%dm%02ds' % divmod(eta, 60),
+            stats['queued'],
+            stats['running'],
+            stats['idle_slots'],
+            stats['retries'],
+            stats['speculated'],
+            '?' if stats['mean_runtime_seconds'] is None else stats['mean_runtime_seconds'],
+            '?' if stats['mean_ssh_overhead_seconds'] is None else stats['mean_ssh_overhead_seconds'])
+
+
+class _PmapWorkers:
+    """
+    the slots of the instances pmap and pipeline run jobs on. jobs are
+    started and watched from their own threads, which report back
+    through one queue, so the scheduler never blocks on ssh. an instance
+    which ec2 says is no longer running, or which keeps failing ssh, is
+    dropped, and each job it was running is handed to requeue().
+    """
+
+    def __init__(self, instances, slots, session, requeue, describe, dropped=lambda instance: None, rescan=False):
+        self.slots = slots
+        self.session = session
+        self.requeue = requeue # fn(slot, job) for a job which will never report back
+        self.describe = describe # fn(job) for log lines
+        self.dropped = dropped # fn(instance) once an instance is dropped
+        self.rescan = rescan # with rescan, instances can come back, so the pool may go empty
+        self.nums = {} # instance -> worker_num
+        self.idle = []
+        self.dead = set()
+        self.failures = collections.Counter() # consecutive ssh failures per instance
+        self.active = {} # slot -> job
+        self.watched = {} # slot -> (cmd, batch) of its job
+        self.load = collections.Counter()
+        self.began = {} # slot -> start time
+        self.heard = {} # instance -> last time one of its watchers reported back
+        self.completions = queue.Queue() # (kind, slot, value) from start and watch threads
+        self.last_silent_check = time.time()
+        self.add(instances)
+
+    def add(self, instances):
+        if self.slots == 'auto':
+            vcpus = _vcpus(*[i.instance_type for i in instances])
+        for instance in instances:
+            self.nums[instance] = len(self.nums)
+            n = vcpus[instance.instance_type] if self.slots == 'auto' else int(self.slots)
+            self.idle.extend((instance, slot_num) for slot_num in range(n))
+
+    def assign(self, slot, job, cmd, batch):
+        self.load[slot[0]] += 1
+        self.active[slot] = job
+        self.watched[slot] = (cmd, batch)
+        self.began[slot] = time.time()
+
+    def start(self, slot, **fields):
+        threading.Thread(target=self._start, args=(slot, self.active[slot], fields) + self.watched[slot], daemon=True).start()
+
+    # starts are not retried, an ssh failure goes back through completions
+    # for check() to judge. anything else is a bug here, not a bad instance.
+    def _start(self, slot, job, fields, cmd, batch):
+        instance, slot_num = slot
+        try:
+            _pmap_start(instance, cmd, batch, self.nums[instance], slot_num, **fields)
+        except subprocess.CalledProcessError as e:
+            self.completions.put(('start', slot, e))
+        except Exception as e:
+            self.completions.put(('error', slot, e))
+        else:
+            logging.info('started: %s, instance: %s, slot: %s, session: %s', self.describe(job), instance.instance_id, slot_num, self.session)
+            self._watch(slot, cmd, batch)
+
+    def adopt(self, slot, job, cmd, batch):
+        self.idle.remove(slot)
+        self.assign(slot, job, cmd, batch)
+        logging.info('adopted: %s, instance: %s, slot: %s, session: %s', self.describe(job), slot[0].instance_id, slot[1], self.session)
+        threading.Thread(target=self._watch, args=(slot, cmd, batch), daemon=True).start()
+
+    # every started job gets a thread blocked on a remote watcher, which
+    # reports back as soon as the job exits
+    def _watch(self, slot, cmd, batch):
+        try:
+            self.completions.put(('watch', slot, _pmap_watch(slot[0], cmd, batch)))
+        except subprocess.CalledProcessError as e:
+            self.completions.put(('watch', slot, e))
+        except Exception as e:
+            self.completions.put(('error', slot, e))
+
+    def _pop(self, slot):
+        self.load[slot[0]] -= 1
+        self.watched.pop(slot)
+        return self.active.pop(slot), self.began.pop(slot)
+
+    def finish(self, slot):
+        # a job reported back, so its slot is free again. returns (job, start time)
+        self.idle.append(slot)
+        return self._pop(slot)
+
+    def release(self, slot):
+        # a slot whose job will never report back gives it up
+        job, _ = self._pop(slot)
+        self.requeue(slot, job)
+
+    def drop(self, instance, reason):
+        logging.info('dropping: instance: %s, because: %s, session: %s', instance.instance_id, reason, self.session)
+        self.dead.add(instance)
+        self.idle[:] = [slot for slot in self.idle if slot[0] != instance]
+        for slot in [slot for slot in self.active if slot[0] == instance]:
+            self.release(slot)
+        self.dropped(instance)
+        assert self.rescan or len(self.dead) < len(self.nums), 'every instance is dead, session: %s' % self.session
+
+    # called after a failed start, or a watcher whose ssh has already
+    # been retried. the run continues at reduced capacity without
+    # instances which are dropped.
+    def check(self, instance, error):
+        if instance in self.dead:
+            return False
+        self.failures[instance] += 1
+        if not _retry(_ls)([instance.instance_id], state='running', cache=False):
+            self.drop(instance, 'not running')
+        elif self.failures[instance] >= 3:
+            self.drop(instance, 'ssh failed %s times: %s' % (self.failures[instance], error))
+        else:
+            logging.info('ssh failed, but instance is running: instance: %s, error: %s, session: %s', instance.instance_id, error, self.session)
+        return instance not in self.dead
+
+    # a watcher can sit silent for the whole run of a long job, so
+    # instances which have not reported back in a while are asked
+    # after in ec2, whether or not there is a rescan
+    def check_silent(self):
+        now = time.time()
+        silent = {slot[0] for slot in self.active if now - self.heard.get(slot[0], self.began[slot]) > _pmap_silent_seconds}
+        if silent:
+            found_ids = {instance.instance_id for instance in _retry(_ls)([instance.instance_id for instance in silent], state='running', cache=False)}
+            for instance in silent:
+                if instance.instance_id not in found_ids:
+                    self.drop(instance, 'not running')
+        self.last_silent_check = time.time()
+
+    def next(self, timeout):
+        """
+        wait up to timeout for a job to report back, and return (slot,
+        {arg_num: (exit_code, stdout, runtime_seconds)}), or None. failed
+        starts and watchers are dealt with here.
+        """
+        if time.time() - self.last_silent_check >= _pmap_silent_check_seconds:
+            self.check_silent()
+        timeout = min(timeout, max(0, self.last_silent_check + _pmap_silent_check_seconds - time.time()))
+        if not self.active:
+            time.sleep(timeout)
+            return
+        try:
+            kind, slot, results = self.completions.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if kind == 'error':
+            raise results
+        if slot not in self.active: # from an instance which was dropped
+            return
+        instance = slot[0]
+        if kind == 'start':
+            self.release(slot)
+            self.idle.append(slot)
+            self.check(instance, results)
+            return
+        self.heard[instance] = time.time()
+        if isinstance(results, Exception):
+            if self.check(instance, results): # still up, so watch the job again
+                threading.Thread(target=self._watch, args=(slot,) + self.watched[slot], daemon=True).start()
+            return
+        self.failures[instance] = 0
+        return slot, results
+
+
+def _pmap_source(args):
+    """
+    args are read lazily, so millions of them never need to fit in argv
+    or memory. the first value yielded is how many args there are, or None
+    for stdin, which can only be read once, and then each arg. a file is
+    given as @path, so a literal arg is never mistaken for a file name.
+    """
+    if args == '-':
+        yield None
+        for line in sys.stdin:
+            yield line.rstrip('\n')
+    elif args.startswith('@'):
+        with open(args[1:]) as f:
+            yield sum(1 for _ in f)
+            f.seek(0)
+            for line in f:
+                yield line.rstrip('\n')
+    else:
+        args = args.split(',')
+        yield len(args)
+        yield from args
+
+
+def pmap(instance_ids: 'comma separated ec2 instance ids to run cmds on, or with --rescan any selectors',
+         args: 'comma separated strings, @path to a file with one arg per line, or - to read lines from stdin. each is supplied as stdin to cmd',
+         cmd: '{worker_num} and {slot_num} can be used as unique integer ids per worker and per slot on that worker',
          retries: 'how many times to retry each arg' = 10,
-         retry_sleep: 'seconds to sleep before retrying' = 30):
-    args = args.split(',')
+         retry_sleep: 'seconds to sleep before retrying' = 30,
+         slots: 'concurrent jobs per instance, or "auto" for one per vcpu' = '1',
+         batch_size: 'pack up to this many args into each job, to amortize ssh round trips over many small args' = 1,
+         batch_bytes: 'also stop packing args into a job once it has this many bytes of args. 0 for no limit' = 0,
+         stream_results: (
+             'print each result as it completes as a line of json '
+             '{"arg_num": n, "result": stdout} instead of returning '
+             'them all at the end. "ordered" or "unordered"') = None,
+         reorder_buffer: 'with --stream-results ordered, max args to run ahead of the oldest unfinished arg' = 1000,
+         speculate: (
+             'when there is nothing else to run, start a duplicate of any '
+             'arg running longer than this many times the median runtime '
+             'on an idle slot of another instance. the first success wins '
+             'and the other copy is killed. cmd must be idempotent. 0 to disable') = 0.0,
+         rescan: (
+             'seconds between re-running the instance_ids selectors. '
+             'new matching instances join the pool, and ones no longer '
+             'running are dropped. 0 to disable') = 0,
+         status_interval: 'seconds between status lines with throughput, eta and overhead' = 10,
+         stats_file: 'write final throughput and latency stats to this path as json' = None,
+         resume: (
+             'session id of a pmap whose driver died. '
+             'rerun the same command with --resume <session>. '
+             'running jobs are re-adopted, finished outputs '
+             'are harvested, and only what is left is run.') = None):
+    assert stream_results in [None, 'ordered', 'unordered'], '--stream-results must be ordered or unordered'
+    cmd.format(worker_num=0, slot_num=0) # fail now on a bad template, not as an ssh failure on every instance
     instance_ids = instance_ids.split(',')
     instances = list(_ls(instance_ids, state='running'))
-    assert len(instances) == len(instance_ids)
-    nums = {instance: i for i, instance in enumerate(instances)}
-    active = {}
-    results = {}
-    numbered_args = list(reversed(list(enumerate(args))))
+    assert rescan or len(instances) == len(instance_ids)
+    numbered_args = collections.deque() # retries go on the left, new args on the right
+    delayed = [] # heap of (retry_at, arg_num, arg)
     retried = collections.Counter()
-    session = str(uuid.uuid4()).split('-')[-1]
-    # process every arg
-    while numbered_args or active:
-        assert len(active) <= len(instances)
-        # start jobs on available instances
-        def start(x):
-            instance, (arg_num, arg) = x
-            ssh(instance,
-                cmd=_cmd(cmd, arg_num, nums[instance]),
-                no_tty=True,
-                yes=True,
-                quiet=True,
-                stdin=arg)
-            active[instance] = (arg_num, arg)
-            logging.info('started: arg_num: %s, instance: %s, session: %s', arg_num, instance.instance_id, session)
-        random.shuffle(instances)
-        to_start = [(i, numbered_args.pop())
-                    for i in instances
-                    if i not in active
-                    and numbered_args]
-        list(pool.thread.map(start, to_start))
-        # check for completed jobs and handle outputs
-        def check(x):
-            instance, (arg_num, arg) = x
-            res = _retry(ssh)(
-                instance,
-                cmd='tail -n1 %s' % _stderr_file(arg_num, cmd),
-                quiet=True,
-                no_stream=True,
-                yes=True,
-            )
-            if res.startswith('exited: '):
-                code = res.split()[-1]
+    finished = {} # ordered results waiting on an earlier arg
+    copies = collections.defaultdict(set) # unsettled arg_num -> slots running it, more than one when speculating
+    cancelled = set() # slots running a copy which lost, waiting for their watcher to report back
+    durations = collections.deque(maxlen=1000) # recent successful job runtimes, for spotting stragglers
+    if resume:
+        session = resume
+        assert os.path.exists(_pmap_journal_path(session)), 'no journal for session: %s' % session
+        db, journal = _pmap_journal(session)
+        meta = dict(db.execute('select key, value from meta'))
+        assert meta, 'no journal for session: %s' % session
+        assert meta['cmd'] == cmd, 'cmd does not match the cmd of session: %s' % session
+        assert meta['stream_results'] == str(stream_results), '--stream-results does not match session: %s' % session
+        ingested = int(meta['ingested'])
+    else:
+        session = str(uuid.uuid4()).split('-')[-1]
+        db, journal = _pmap_journal(session)
+        db.executemany('insert into meta values (?, ?)', [('cmd', cmd), ('stream_results', str(stream_results)), ('ingested', '0')])
+        db.commit()
+        ingested = 0
+    # on resume the source is read again from the start, skipping what the journal already has
+    source = _pmap_source(args)
+    total = next(source)
+    source = enumerate(itertools.islice(source, ingested, None), ingested)
+    exhausted = False
+    logging.info('session: %s, journal: %s', session, journal)
+    def ingest(n):
+        nonlocal ingested, exhausted
+        new = list(itertools.islice(source, n))
+        exhausted = len(new) < n
+        db.executemany("insert into args (arg_num, arg, state, retries) values (?, ?, 'queued', 0)", new)
+        ingested += len(new)
+        db.execute("update meta set value = ? where key = 'ingested'", (str(ingested),))
+        numbered_args.extend(new)
+    # results are either kept in the journal and returned at the
+    # end, or printed once and dropped by marking them emitted
+    def emit(arg_num, result):
+        print(json.dumps({'arg_num': arg_num, 'result': result}), flush=True)
+        db.execute("update args set state = 'emitted', result = null where arg_num = ?", (arg_num,))
+    def next_emit():
+        return db.execute("select coalesce(min(arg_num), ?) from args where state != 'emitted'", (ingested,)).fetchone()[0]
+    def arg_nums(batch):
+        return ','.join(str(arg_num) for arg_num, _ in batch)
+    def assign(slot, batch):
+        workers.assign(slot, batch, cmd, batch)
+        for arg_num, _ in batch:
+            copies[arg_num].add(slot)
+    def kill(slot, batch):
+        try:
+            ssh(slot[0], cmd=_kill_cmd(cmd), cmd_args=[arg_num for arg_num, _ in batch], no_tty=True, yes=True, quiet=True)
+        except Exception:
+            logging.info('failed to kill: arg_num: %s, instance: %s, slot: %s, session: %s', arg_nums(batch), slot[0].instance_id, slot[1], session)
+    # pack queued args into one job, up to --batch-size args or --batch-bytes of args.
+    # when streaming in order, stop running ahead once the reorder buffer would fill.
+    def take():
+        batch, size = [], 0
+        while (numbered_args
+               and len(batch) < batch_size
+               and (not batch or not batch_bytes or size + len(numbered_args[0][1].encode()) <= batch_bytes)
+               and (stream_results != 'ordered' or numbered_args[0][0] < oldest + reorder_buffer)):
+            batch.append(numbered_args.popleft())
+            size += len(batch[-1][1].encode())
+        return sorted(batch)
+    # a slot whose job will never report back gives up its args, which
+    # go back on the queue without counting as a retry, unless another
+    # copy of them is still running
+    def requeue(slot, batch):
+        for arg_num, _ in batch:
+            if arg_num in copies:
+                copies[arg_num].discard(slot)
+        if slot in cancelled:
+            cancelled.remove(slot)
+            return
+        for arg_num, arg in reversed(batch):
+            if arg_num in copies and not copies[arg_num]:
+                copies.pop(arg_num)
+                numbered_args.appendleft((arg_num, arg))
+                db.execute("update args set state = 'queued' where arg_num = ?", (arg_num,))
+                logging.info('requeued: arg_num: %s, instance: %s, session: %s', arg_num, slot[0].instance_id, session)
+    workers = _PmapWorkers(instances, slots, session, requeue, lambda batch: 'arg_num: %s' % arg_nums(batch), rescan=rescan)
+    idle, active, load, began = workers.idle, workers.active, workers.load, workers.began
+    def rescan_instances():
+        found = _retry(_ls)(instance_ids, state='running', cache=False)
+        found_ids = {instance.instance_id for instance in found}
+        for instance in list(workers.nums):
+            if instance not in workers.dead and instance.instance_id not in found_ids:
+                workers.drop(instance, 'no longer running')
+        new = [instance for instance in found if instance not in workers.nums]
+        if new:
+            logging.info('adding: instances: %s, session: %s', ','.join(instance.instance_id for instance in new), session)
+            workers.add(new)
+    # load state from the journal, re-adopting jobs which are still on a known slot
+    by_id = {instance.instance_id: instance for instance in instances}
+    running = collections.defaultdict(list)
+    for arg_num, arg, state, instance_id, slot_num, n, result in db.execute('select arg_num, arg, state, instance_id, slot_num, retries, result from args where state != ? order by arg_num', ('emitted',)):
+        retried[arg_num] = n
+        if state == 'running' and (by_id.get(instance_id), slot_num) in idle:
+            running[(by_id[instance_id], slot_num)].append((arg_num, arg))
+        elif state == 'done' and stream_results == 'ordered':
+            finished[arg_num] = result
+        elif state != 'done':
+            numbered_args.append((arg_num, arg))
+    for slot, batch in running.items():
+        for arg_num, _ in batch:
+            copies[arg_num].add(slot)
+        workers.adopt(slot, batch, cmd, batch)
+    oldest = next_emit()
+    stats = _PmapStats(done=db.execute("select count(*) from args where state in ('done', 'emitted')").fetchone()[0])
+    def report(force=False):
+        if force or time.time() - stats.last_render >= status_interval:
+            stats.last_render = time.time()
+            remaining = total if total is not None else ingested if exhausted else None
+            x = stats.stats(None if remaining is None else remaining - stats.done, len(numbered_args) + len(delayed), len(active), len(idle))
+            logging.info(stats.render(x))
+            return x
+    while oldest in finished:
+        emit(oldest, finished.pop(oldest))
+        oldest += 1
+    # process every arg. idle slots pull from one shared queue, so a
+    # worker with more cores, or shorter jobs, naturally takes more args.
+    last_rescan = time.time()
+    # whatever stops the driver, leave the journal committed and unlocked for --resume
+    try:
+        while True:
+            if rescan and time.time() - last_rescan >= rescan:
+                rescan_instances()
+                last_rescan = time.time()
+            while delayed and delayed[0][0] <= time.time():
+                _, arg_num, arg = heapq.heappop(delayed)
+                numbered_args.appendleft((arg_num, arg))
+            if len(numbered_args) < len(idle) * batch_size and not exhausted:
+                ingest(len(idle) * batch_size - len(numbered_args))
+            if not (numbered_args or delayed or active):
+                break
+            # start jobs on idle slots, spreading load across the least busy workers first
+            to_start = []
+            while idle and numbered_args:
+                batch = take()
+                if not batch:
+                    break
+                idle.sort(key=lambda slot: load[slot[0]], reverse=True)
+                slot = idle.pop()
+                assign(slot, batch)
+                to_start.append((slot, batch))
+                for arg_num, _ in batch:
+                    stats.start(arg_num)
+                    db.execute("update args set state = 'running', instance_id = ?, slot_num = ? where arg_num = ?", (slot[0].instance_id, slot[1], arg_num))
+            # with nothing else to run, duplicate stragglers onto idle slots of other instances
+            next_straggler = None
+            if speculate and idle and len(durations) >= 5:
+                threshold = speculate * sorted(durations)[len(durations) // 2]
+                now = time.time()
+                running = [slot for slot in active
+                           if slot not in cancelled
+                           and all(len(copies.get(arg_num, ())) == 1 for arg_num, _ in active[slot])]
+                stragglers = sorted([slot for slot in running if now - began[slot] > threshold], key=lambda slot: began[slot])
+                # wake up when the next running job becomes a straggler, not at the next status line
+                next_straggler = min([began[slot] + threshold for slot in running if slot not in stragglers], default=None)
+                for straggler in stragglers:
+                    free = sorted([slot for slot in idle if slot[0] != straggler[0]], key=lambda slot: load[slot[0]])
+                    if free:
+                        slot = free[0]
+                        idle.remove(slot)
+                        assign(slot, active[straggler])
+                        to_start.append((slot, active[slot]))
+                        stats.speculated += 1
+                        logging.info('speculating: arg_num: %s, instance: %s, slot: %s, session: %s', arg_nums(active[slot]), slot[0].instance_id, slot[1], session)
+            db.commit()
+            for slot, _ in to_start:
+                workers.start(slot)
+            report()
+            # wait for the next completed job, the next retry, rescan or straggler to be due, or the next status line
+            timeout = status_interval
+            if delayed:
+                timeout = min(timeout, max(0, delayed[0][0] - time.time()))
+            if rescan:
+                timeout = min(timeout, max(0, last_rescan + rescan - time.time()))
+            if next_straggler:
+                timeout = min(timeout, max(0, next_straggler - time.time()))
+            completed = workers.next(timeout)
+            db.commit()
+            if not completed:
+                continue
+            slot, results = completed
+            instance, slot_num = slot
+            batch, started = workers.finish(slot)
+            for arg_num, _ in batch:
+                if arg_num in copies:
+                    copies[arg_num].discard(slot)
+            if slot in cancelled:
+                cancelled.remove(slot)
+                logging.info('cancelled: arg_num: %s, instance: %s, slot: %s, session: %s', arg_nums(batch), instance.instance_id, slot_num, session)
+                continue
+            if any(code == '0' for code, _, _ in results.values()):
+                durations.append(time.time() - started)
+            for arg_num, arg in batch:
+                if arg_num not in copies: # already settled by another copy
+                    continue
+                code, stdout, runtime = results.get(arg_num, ('lost', None, None))
+                if code != '0' and copies[arg_num]:
+                    logging.info('failed, still running elsewhere: arg_num: %s, instance: %s, slot: %s, session: %s', arg_num, instance.instance_id, slot_num, session)
+                    continue
+                stats.finish(arg_num, instance.instance_id, code == '0', runtime)
                 if code == '0':
-                    logging.info('success: arg_num: %s, instance: %s, session: %s', arg_num, instance.instance_id, session)
-                    results[arg_num] = _retry(ssh)(
-                        instance,
-                        cmd='cat %s' % _stdout_file(arg_num, cmd),
-                        quiet=True,
-                        no_stream=True,
-                        yes=True,
-                    )
-                    del active[instance]
+                    logging.info('success: arg_num: %s, instance: %s, slot: %s, session: %s', arg_num, instance.instance_id, slot_num, session)
+                    # kill other copies once everything they were running is settled
+                    for other in copies.pop(arg_num):
+                        if other not in cancelled and all(n not in copies for n, _ in active[other]):
+                            cancelled.add(other)
+                            threading.Thread(target=kill, args=(other, active[other]), daemon=True).start()
+                    db.execute("update args set state = 'done', result = ? where arg_num = ?", (stdout, arg_num))
+                    if stream_results == 'unordered':
+                        emit(arg_num, stdout)
+                    elif stream_results == 'ordered':
+                        finished[arg_num] = stdout
+                        while oldest in finished:
+                            emit(oldest, finished.pop(oldest))
+                            oldest += 1
                 else:
+                    copies.pop(arg_num)
                     retried[arg_num] += 1
+                    db.execute("update args set state = 'queued', retries = ? where arg_num = ?", (retried[arg_num], arg_num))
                     assert retried[arg_num] < retries, 'error: arg_num: %s, instance: %s, retried: %s, session: %s' % (arg_num, instance.instance_id, retries, session)
                     logging.info('retrying: arg_num: %s, instance: %s, retried: %s, session: %s', arg_num, instance.instance_id, retried[arg_num], session)
-                    numbered_args.append((arg_num, arg))
-                    time.sleep(retry_sleep)
-        list(pool.thread.map(check, list(active.items())))
-    assert len(results) == len(args), 'mismatch result sizes'
-    return [results[arg_num] for arg_num, _ in enumerate(args)]
+                    heapq.heappush(delayed, (time.time() + retry_sleep, arg_num, arg))
+            db.commit()
+    except BaseException:
+        db.commit()
+        db.close()
+        raise
+    x = report(force=True)
+    if stats_file:
+        with open(stats_file, 'w') as f:
+            json.dump(x, f, indent=2)
+    if stream_results:
+        assert next_emit() == ingested, 'mismatch result sizes'
+        results = None
+    else:
+        results = [result for result, in db.execute("select result from args where state = 'done' order by arg_num")]
+        assert len(results) == ingested, 'mismatch result sizes'
+    db.close()
+    for path in glob.glob(journal + '*'): # includes the -wal and -shm files
+        os.remove(path)
+    return results
+
+
+def pipeline(instance_ids: 'comma separated ec2 instance ids to run cmds on',
+             args: 'comma separated strings, @path to a file with one arg per line, or - to read lines from stdin',
+             *cmds,
+             retries: 'how many times to retry each arg at each stage' = 10,
+             retry_sleep: 'seconds to sleep before retrying' = 30,
+             slots: 'concurrent jobs per instance, or "auto" for one per vcpu' = '1',
+             no_steal: 'never move an arg off the instance which produced it, even when other instances are idle' = False,
+             status_interval: 'seconds between status lines with throughput, eta and overhead' = 10):
+    """
+    run args through a chain of cmds, one per stage, where the stdout of
+    each stage is the stdin of the next, and return the stdout of the
+    last stage. there is no barrier between stages, an arg moves on as
+    soon as it finishes a stage. the next stage runs on the instance
+    which produced its input when possible, so intermediate data can stay
+    on local disk. an idle instance steals work from busy ones, and
+    {producer} in a cmd is the private ip of the instance which ran the
+    previous stage, so a stage can fetch its input over the lan instead
+    of from s3. {worker_num} and {slot_num} work as with pmap, and so do
+    dead instances, which are dropped while their jobs run elsewhere.
+    """
+    assert cmds, 'need at least one cmd'
+    instance_ids = instance_ids.split(',')
+    instances = list(_ls(instance_ids, state='running'))
+    assert len(instances) == len(instance_ids)
+    session = str(uuid.uuid4()).split('-')[-1]
+    # a job is (stage, arg_num, arg, producer), where producer is the
+    # instance which ran the previous stage, or None for the first stage
+    fresh = collections.deque()
+    local = collections.defaultdict(collections.deque)
+    origin = {} # arg_num -> arg, for starting over an arg whose input was lost with its producer
+    delayed = [] # heap of (retry_at, tiebreak, job)
+    tiebreak = itertools.count()
+    retried = collections.Counter()
+    results = {}
+    source = _pmap_source(args)
+    total = next(source)
+    source = enumerate(source)
+    ingested = 0
+    exhausted = False
+    stats = _PmapStats()
+    for cmd in cmds:
+        cmd.format(producer='', worker_num=0, slot_num=0) # fail now on a bad template, not once per job
+    uses_producer = [any(field == 'producer' for _, field, _, _ in string.Formatter().parse(cmd)) for cmd in cmds]
+    def describe(job):
+        return 'stage: %s, arg_num: %s' % job[:2]
+    # a job goes back on the queue of its producer, and if the producer
+    # was dropped, to any instance. a stage which fetches its input from
+    # a dropped producer cannot run anymore, so its arg starts over.
+    def enqueue(job):
+        stage, arg_num, arg, producer = job
+        if producer in workers.dead:
+            job = (0, arg_num, origin[arg_num], None) if uses_producer[stage] else (stage, arg_num, arg, None)
+        (local[job[3]] if job[3] else fresh).appendleft(job)
+    def requeue(slot, job):
+        logging.info('requeued: %s, instance: %s, session: %s', describe(job), slot[0].instance_id, session)
+        enqueue(job)
+    def dropped(instance):
+        while local[instance]:
+            enqueue(local[instance].pop())
+    workers = _PmapWorkers(instances, slots, session, requeue, describe, dropped)
+    idle, active, load = workers.idle, workers.active, workers.load
+    # an instance runs what it produced first, which drains the pipeline
+    # and keeps intermediate data small, then new args, then steals from
+    # the back of the busiest instance's queue
+    def take(instance):
+        if local[instance]:
+            return local[instance].popleft()
+        if fresh:
+            return fresh.popleft()
+        if not no_steal and local:
+            victim = max(local, key=lambda i: len(local[i]))
+            if local[victim]:
+                logging.info('stealing: arg_num: %s, from: %s, to: %s', local[victim][-1][1], victim.instance_id, instance.instance_id)
+                return local[victim].pop()
+    def report(force=False):
+        if force or time.time() - stats.last_render >= status_interval:
+            stats.last_render = time.time()
+            remaining = total if total is not None else ingested if exhausted else None
+            queued = len(fresh) + sum(len(x) for x in local.values()) + len(delayed)
+            x = stats.stats(None if remaining is None else remaining * len(cmds) - stats.done, queued, len(active), len(idle))
+            logging.info(stats.render(x))
+    logging.info('session: %s', session)
+    while True:
+        while delayed and delayed[0][0] <= time.time():
+            enqueue(heapq.heappop(delayed)[-1])
+        if len(fresh) < len(idle) and not exhausted:
+            new = list(itertools.islice(source, len(idle) - len(fresh)))
+            exhausted = len(new) < len(idle) - len(fresh)
+            ingested += len(new)
+            origin.update(new)
+            fresh.extend((0, arg_num, arg, None) for arg_num, arg in new)
+        if not (fresh or delayed or active or any(local.values())):
+            break
+        for slot in sorted(idle, key=lambda slot: load[slot[0]]):
+            job = take(slot[0])
+            if job:
+                stage, arg_num, arg, producer = job
+                idle.remove(slot)
+                workers.assign(slot, job, cmds[stage], [(arg_num, arg)])
+                stats.start(job[:2])
+                workers.start(slot, producer=producer.private_ip_address if producer else '')
+        report()
+        completed = workers.next(min(status_interval, max(0, delayed[0][0] - time.time())) if delayed else status_interval)
+        if not completed:
+            continue
+        slot, res = completed
+        instance, slot_num = slot
+        job, _ = workers.finish(slot)
+        stage, arg_num, arg, producer = job
+        code, stdout, runtime = res.get(arg_num, ('lost', None, None))
+        stats.finish(job[:2], instance.instance_id, code == '0', runtime)
+        if code == '0':
+            logging.info('success: stage: %s, arg_num: %s, instance: %s, slot: %s', stage, arg_num, instance.instance_id, slot_num)
+            if stage + 1 < len(cmds):
+                local[instance].append((stage + 1, arg_num, stdout, instance))
+            else:
+                results[arg_num] = stdout
+                origin.pop(arg_num)
+        else:
+            retried[job[:2]] += 1
+            assert retried[job[:2]] < retries, 'error: stage: %s, arg_num: %s, instance: %s, retried: %s' % (stage, arg_num, instance.instance_id, retries)
+            logging.info('retrying: stage: %s, arg_num: %s, instance: %s, retried: %s', stage, arg_num, instance.instance_id, retried[job[:2]])
+            heapq.heappush(delayed, (time.time() + retry_sleep, next(tiebreak), job))
+    report(force=True)
+    assert len(results) == ingested, 'mismatch result sizes'
+    return [results[arg_num] for arg_num in range(ingested)]
 
 
 def lambda_ami():
@@ -1867,8 +3601,7 @@ _region_names = {
 
 
 def _current_region():
-    _client() # run session setup logic
-    return boto3.DEFAULT_SESSION.region_name
+    return _session().region_name
 
 
 # TODO this can probably be cached for some time period
@@ -1892,7 +3625,7 @@ def prices(instance_type=None):
                  "Field": "instanceType",
                  "Value": instance_type}
             )
-        xs = boto3.client('pricing').get_products(ServiceCode='AmazonEC2', Filters=filters)['PriceList']
+        xs = _cached_client('pricing').get_products(ServiceCode='AmazonEC2', Filters=filters)['PriceList']
         res = []
         for x in xs:
             x = json.loads(x)
@@ -1,4 +1,3 @@
-import boto3
 import argh
 import logging
 import os
@@ -15,18 +14,18 @@ import util.log
 import util.strings
 import util.time
 from unittest import mock
-from aws.ec2 import _region, _pretty, _ls
+from aws.ec2 import _region, _pretty, _ls, _cached_client
 
 
 is_cli = False
 
 
 def _client_classic():
-    return boto3.client('elb')
+    return _cached_client('elb')
 
 
 def _client():
-    return boto3.client('elbv2')
+    return _cached_client('elbv2')
 
 
 @argh.arg('name', nargs='?', default=None)
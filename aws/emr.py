@@ -1,5 +1,3 @@
-import boto3
-import contextlib
 import logging
 import os
 import shell
@@ -10,34 +8,36 @@ import util.colors
 import util.log
 from unittest import mock
 import aws.ec2
+from aws.ec2 import _region, _map_regions
 
 is_cli = False
 
 
 def _resource():
-    return boto3.resource('emr')
+    return aws.ec2._cached_resource('emr')
 
 
 def _client():
-    return boto3.client('emr')
+    return aws.ec2._cached_client('emr')
 
 
-@contextlib.contextmanager
-def _region(name):
-    session = boto3.DEFAULT_SESSION
-    boto3.setup_default_session(region_name=name)
-    try:
-        yield
-    finally:
-        boto3.DEFAULT_SESSION = session
+def ls(state: 'use "all" to see everything' = 'running',
+       all_regions: 'query every region concurrently' = False):
+    if all_regions:
+        logging.info('region name id instance-hours state creation-date')
+        for region, xs in _map_regions(lambda: _clusters(state)):
+            for x in xs:
+                yield '%s %s' % (region, x)
+    else:
+        logging.info('name id instance-hours state creation-date')
+        yield from _clusters(state)
 
 
-def ls(state: 'use "all" to see everything' = 'running'):
+def _clusters(state):
     kw = {}
     if state.lower() != 'all':
         assert state.upper() in ['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING', 'TERMINATING', 'TERMINATED', 'TERMINATED_WITH_ERRORS']
         kw['ClusterStates'] = [state.upper()]
-    logging.info('name id instance-hours state creation-date')
     for resp in _client().get_paginator('list_clusters').paginate(**kw):
         for cluster in resp['Clusters']:
             yield ' '.join(map(str, [
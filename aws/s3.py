@@ -1,7 +1,6 @@
 import aws.ec2
 import argh
 import tzlocal
-import boto3
 import logging
 import os
 import pprint
@@ -12,18 +11,18 @@ import util.colors
 import util.iter
 import util.log
 from unittest import mock
-from aws.ec2 import _retry
+from aws.ec2 import _retry, _cached_client, _cached_resource
 
 
 is_cli = False
 
 
 def _resource():
-    return boto3.resource('s3')
+    return _cached_resource('s3')
 
 
 def _client():
-    return boto3.client('s3')
+    return _cached_client('s3')
 
 
 @argh.arg('s3_url', nargs='?', default=None)
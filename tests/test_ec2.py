@@ -0,0 +1,493 @@
+import base64
+import io
+import json
+import os
+import pytest
+import subprocess
+import threading
+import time
+import types
+import shell
+import aws.ec2 as ec2
+
+def bash(script, *args, stdin=b'', env=None):
+    return subprocess.run(['bash', '-c', script, 'bash'] + [str(x) for x in args], input=stdin, stdout=subprocess.PIPE, env=env)
+
+def batch(*args):
+    return b''.join(b'%d %s\n' % (n, base64.b64encode(arg.encode())) for n, arg in enumerate(args))
+
+fake_ssh = """#!/bin/bash
+# stands in for ssh, running the remote cmd in a directory per host
+echo "$*" >> $FAKE_HOSTS/ssh.log
+while [ $# -gt 0 ]; do
+    case $1 in
+        -o|-i) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+host=${1#*@}
+shift
+[ -e $FAKE_HOSTS/$host.dead ] && exit 255
+mkdir -p $FAKE_HOSTS/$host
+cd $FAKE_HOSTS/$host && HOME=$FAKE_HOSTS/$host exec bash -c "$*"
+"""
+
+class Hosts:
+    def __init__(self, root, n):
+        self.root = root
+        self.instances = [ec2._Instance({'InstanceId': 'i-%d' % i,
+                                         'InstanceType': 't3.micro',
+                                         'State': {'Name': 'running'},
+                                         'LaunchTime': '2020-01-01T00:00:00',
+                                         'PublicDnsName': 'host%d' % i,
+                                         'PrivateIpAddress': 'host%d' % i,
+                                         'Tags': [{'Key': 'Name', 'Value': 'host%d' % i}, {'Key': 'ssh-user', 'Value': 'user'}]})
+                          for i in range(n)]
+
+    def path(self, instance, *parts):
+        return os.path.join(self.root, instance.public_dns_name, *parts)
+
+    def kill(self, instance):
+        open(os.path.join(self.root, instance.public_dns_name + '.dead'), 'w').close()
+
+    def running(self, tags=(), *a, **kw):
+        running = [i for i in self.instances if not os.path.exists(os.path.join(self.root, i.public_dns_name + '.dead'))]
+        ids = {i.instance_id for i in self.instances}
+        if tags and all(tag in ids for tag in tags):
+            running = [i for i in running if i.instance_id in tags]
+        return running
+
+@pytest.fixture
+def hosts(tmp_path, monkeypatch):
+    # three fake instances, whose ssh runs locally, each in its own directory
+    os.makedirs(str(tmp_path / 'bin'))
+    with open(str(tmp_path / 'bin/ssh'), 'w') as f:
+        f.write(fake_ssh)
+    os.chmod(str(tmp_path / 'bin/ssh'), 0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmp_path / 'bin', os.environ['PATH']))
+    monkeypatch.setenv('FAKE_HOSTS', str(tmp_path / 'hosts'))
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    hosts = Hosts(str(tmp_path / 'hosts'), 3)
+    for instance in hosts.instances:
+        os.makedirs(hosts.path(instance))
+    monkeypatch.setattr(ec2, '_ls', hosts.running)
+    monkeypatch.chdir(str(tmp_path))
+    return hosts
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def test_selector_filter():
+    assert ec2._selector_filter('env=prod') == 'tag'
+    assert ec2._selector_filter('i-0123456789abcdef0') == 'instance-id'
+    assert ec2._selector_filter('ec2-1-2-3-4.compute-1.amazonaws.com') == 'dns-name'
+    assert ec2._selector_filter('ip-10-0-0-1.ec2.internal') == 'private-dns-name'
+    assert ec2._selector_filter('vpc-123') == 'vpc-id'
+    assert ec2._selector_filter('subnet-123') == 'subnet-id'
+    assert ec2._selector_filter('sg-123') == 'instance.group-id'
+    assert ec2._selector_filter('10.0.0.1') == 'private-ip-address'
+    assert ec2._selector_filter('54.1.2.3') == 'ip-address'
+    assert ec2._selector_filter('web') == 'name'
+
+def test_plan_filters_values_of_one_tag_are_ored():
+    assert ec2._plan_filters(['web-1', 'web-2'], ['running']) == [[
+        {'Name': 'instance-state-name', 'Values': ['running']},
+        {'Name': 'tag:Name', 'Values': ['web-1', 'web-2']}]]
+
+def test_plan_filters_different_tags_are_anded():
+    assert ec2._plan_filters(['env=prod', 'role=db', 'env=stage'], ['all']) == [[
+        {'Name': 'tag:env', 'Values': ['prod', 'stage']},
+        {'Name': 'tag:role', 'Values': ['db']}]]
+
+def test_plan_filters_scope_narrows_every_identity_plan():
+    ids = ['i-%08d' % i for i in range(400)]
+    plans = ec2._plan_filters(ids + ['vpc-1', 'env=prod'], ['running'])
+    assert len(plans) == 3 # 200 values per filter api limit
+    for plan in plans:
+        assert {'Name': 'vpc-id', 'Values': ['vpc-1']} in plan
+        assert {'Name': 'tag:env', 'Values': ['prod']} in plan
+    assert sum(len(plan[-1]['Values']) for plan in plans) == 400
+
+def test_parse_types():
+    assert ec2._parse_types('i3.large') == [('i3.large', 1)]
+    assert ec2._parse_types('i3.large, i3.xlarge:2') == [('i3.large', 1), ('i3.xlarge', 2)]
+
+def test_pmap_stats():
+    stats = ec2._PmapStats()
+    stats.start(0)
+    stats.finish(0, 'i-1', True, runtime=0.0)
+    stats.start(1)
+    stats.finish(1, 'i-1', False)
+    x = stats.stats(remaining=3, queued=1, running=2, idle=0)
+    assert x['done'] == 1
+    assert x['retries'] == 1
+    assert x['latency_histogram'] == {'i-1': {'<=1s': 2}}
+    assert x['mean_runtime_seconds'] == 0.0
+    assert stats.render(x).startswith('pmap: 1 done, 3 remaining')
+
+def test_cmd_runs_a_batch_and_watch_reports_each_arg():
+    cmd = 'tr a-z A-Z | grep -v FAIL'
+    with shell.tempdir():
+        assert bash(ec2._cmd(cmd, 0), 0, 1, stdin=batch('abc', 'fail')).returncode == 0
+        lines = bash(ec2._watch_cmd(cmd), 0, 1).stdout.decode().splitlines()
+        assert len(lines) == 2
+        n, code, millis, stdout = lines[0].split()
+        assert (n, code, base64.b64decode(stdout)) == ('0', '0', b'ABC\n')
+        assert lines[1].split()[:2] == ['1', '1'] # no stdout
+
+def test_kill_cmd_leaves_args_lost():
+    cmd = 'sleep 60'
+    with shell.tempdir():
+        bash(ec2._cmd(cmd, 0), 0, stdin=batch('x'))
+        while not os.path.exists(ec2._stdout_file(0, cmd)):
+            time.sleep(.01)
+        bash(ec2._kill_cmd(cmd), 0)
+        assert bash(ec2._watch_cmd(cmd), 0).stdout.decode().strip() == '0 lost'
+
+def test_cached_remote_cmd():
+    cmd = 'echo $1 $(cat)'
+    with shell.tempdir() as home:
+        env = dict(os.environ, HOME=home)
+        remote, data, sha = ec2._cached_remote_cmd(cmd, 'i-1', 'arg')
+        assert data == cmd.encode()
+        assert bash(remote, stdin=data + b'input', env=env).stdout == b'arg input\n'
+        ec2._cmd_cache_update('i-1', sha, True)
+        try:
+            remote, data, _ = ec2._cached_remote_cmd(cmd, 'i-1', 'arg')
+            assert data == b''
+            assert bash(remote, stdin=b'again', env=env).stdout == b'arg again\n'
+            os.remove(os.path.join(home, '.cmds', sha))
+            result = bash(remote, stdin=b'again', env=env)
+            assert result.returncode == ec2._cmd_cache_miss_code
+            assert ec2._cmd_cache_miss.encode() in result.stdout
+        finally:
+            ec2._cmd_cache_update('i-1', sha, False)
+
+def test_push_files_match_the_tar_script():
+    with shell.tempdir():
+        for path in ['proj/a.py', 'proj/b.txt', 'proj/.gitignore', 'proj/.git/config', 'proj/.github/ci.yml']:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(path)
+        for name in [None, '*.py']:
+            script = ec2._tar_script('proj', name)
+            tarred = subprocess.check_output('bash %s 2>/dev/null | tar tf -' % script, shell=True).decode().splitlines()
+            assert sorted(ec2._push_files('proj', name)) == sorted(tarred)
+        assert ec2._push_files('proj', '*.py') == ['proj/a.py']
+        assert 'proj/.git/config' in ec2._push_files('proj', None)
+
+def test_scp_remote_path():
+    assert ec2._scp_remote_path('') == '.'
+    assert ec2._scp_remote_path('~') == '.'
+    assert ec2._scp_remote_path('~/big.tar') == 'big.tar'
+    assert ec2._scp_remote_path('/mnt/big.tar') == '/mnt/big.tar'
+
+def test_pmap_watch_survives_binary_and_garbled_stdout(monkeypatch):
+    class Instance:
+        instance_id = 'i-1'
+    out = '0 0 5 %s\n1 0 5 not*base64\n2 1 7\n3 0\n' % base64.b64encode(b'\xff\xfeok\n').decode()
+    monkeypatch.setattr(ec2, 'ssh', lambda *a, **kw: out)
+    results = ec2._pmap_watch(Instance(), 'cmd', [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')])
+    assert results[0] == ('0', '\ufffd\ufffdok', .005)
+    assert results[1] == ('lost', None, None)
+    assert results[2] == ('1', '', .007)
+    assert results[3] == ('lost', None, None)
+
+def test_push_sync_delete_leaves_files_outside_name_alone(hosts):
+    write('proj/a.py', 'a')
+    write('proj/b.py', 'b')
+    host = hosts.instances[0]
+    write(hosts.path(host, 'dst/proj/notes.txt'), 'keep me')
+    write(hosts.path(host, 'dst/proj/stale.py'), 'stale')
+    for verify in [True, False]:
+        ec2.push('proj', 'dst', 'all', yes=True, sync=True, delete=True, verify=verify, name='*.py')
+        assert read(hosts.path(host, 'dst/proj/a.py')) == 'a'
+        assert read(hosts.path(host, 'dst/proj/notes.txt')) == 'keep me'
+        assert not os.path.exists(hosts.path(host, 'dst/proj/stale.py'))
+    # a cached manifest from an unfiltered sync still only deletes within name
+    write('proj/notes.txt', 'local')
+    ec2.push('proj', 'dst', 'all', yes=True, sync=True)
+    os.remove('proj/notes.txt')
+    os.remove('proj/b.py')
+    ec2.push('proj', 'dst', 'all', yes=True, sync=True, delete=True, name='*.py')
+    assert read(hosts.path(host, 'dst/proj/notes.txt')) == 'local'
+    assert not os.path.exists(hosts.path(host, 'dst/proj/b.py'))
+
+def test_pipeline_formats_escaped_braces_once(hosts):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    cmd = "awk '{{print $2}}'"
+    assert ec2.pmap(ids, 'a b,c d', cmd, status_interval=1) == ['b', 'd']
+    assert ec2.pipeline(ids, 'a b,c d', cmd, status_interval=1) == ['b', 'd']
+
+def test_pipeline_runs_each_stage_where_its_input_is(hosts):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    produce = 'x=$(cat); echo $x > $x.txt; echo $x'
+    consume = 'x=$(cat); echo $(cat $x.txt)@{producer}'
+    results = ec2.pipeline(ids, 'a,b,c,d,e,f', produce, consume, no_steal=True, status_interval=1)
+    assert [result.split('@')[0] for result in results] == ['a', 'b', 'c', 'd', 'e', 'f']
+    for result in results:
+        x, producer = result.split('@')
+        assert os.path.exists(os.path.join(hosts.root, producer, x + '.txt'))
+
+def test_pipeline_drops_a_dead_host_and_runs_its_jobs_elsewhere(hosts, monkeypatch):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    dead = hosts.instances[2]
+    hosts.kill(dead)
+    ls = hosts.running
+    monkeypatch.setattr(ec2, '_ls', lambda tags, *a, **kw: hosts.instances if tags == ids.split(',') else ls(tags, *a, **kw))
+    results = ec2.pipeline(ids, 'a,b,c,d,e,f', 'tr a-z A-Z', 'sed s/$/!/', retry_sleep=0, status_interval=1)
+    assert results == ['A!', 'B!', 'C!', 'D!', 'E!', 'F!']
+    assert not os.path.exists(hosts.path(dead, 'cmds.log'))
+
+def test_pmap_fails_fast_on_a_bad_template(hosts):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    with pytest.raises(KeyError):
+        ec2.pmap(ids, 'a', '{ cat; }')
+    assert ec2.pmap(ids, 'a', '{{ cat; }}') == ['a']
+
+def test_pmap_raises_local_errors_instead_of_dropping_instances(hosts, monkeypatch):
+    def start(*a, **kw):
+        raise ValueError('bug')
+    monkeypatch.setattr(ec2, '_pmap_start', start)
+    with pytest.raises(ValueError):
+        ec2.pmap(','.join(i.instance_id for i in hosts.instances), 'a', 'cat')
+
+class FakeFleet:
+    # a spot fleet whose instances arrive one per poll
+    def __init__(self):
+        self.active = []
+        self.target = None
+
+    def request_spot_fleet(self, SpotFleetRequestConfig):
+        self.config = SpotFleetRequestConfig
+        return {'SpotFleetRequestId': 'sfr-1'}
+
+    def describe_spot_fleet_requests(self, SpotFleetRequestIds):
+        return {'SpotFleetRequestConfigs': [{'SpotFleetRequestState': 'active'}]}
+
+    def describe_spot_fleet_instances(self, SpotFleetRequestId):
+        self.active.append({'InstanceId': 'i-%d' % len(self.active), 'InstanceType': 'i3.large'})
+        return {'ActiveInstances': list(self.active)}
+
+    def modify_spot_fleet_request(self, SpotFleetRequestId, TargetCapacity):
+        self.target = TargetCapacity
+
+def test_spot_fleet_which_trickles_in_stops_at_the_deadline(monkeypatch):
+    fleet = FakeFleet()
+    monkeypatch.setattr(ec2, '_client', lambda: fleet)
+    spot_opts = {'TargetCapacity': 5, 'LaunchSpecifications': [{'InstanceType': 'i3.large'}]}
+    assert list(ec2._create_spot_instances(spot_opts, seconds=0)) == [('i-0', 'i3.large')]
+    assert fleet.target == 1
+
+def test_pmap_speculates_a_straggler_as_soon_as_it_is_one(hosts, tmp_path):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    # the first copy of slow hangs, a copy on another instance does not
+    cmd = 'x=$(cat); if [ $x = slow ] && [ ! -e ../slow.started ]; then touch ../slow.started; sleep 60; fi; echo $x'
+    start = time.time()
+    results = ec2.pmap(ids, 'a,b,c,d,e,f,slow', cmd, speculate=3.0, status_interval=30, stats_file=str(tmp_path / 'stats.json'))
+    assert results == ['a', 'b', 'c', 'd', 'e', 'f', 'slow']
+    assert time.time() - start < 15
+    with open(str(tmp_path / 'stats.json')) as f:
+        assert json.load(f)['speculated'] == 1
+
+def test_ssh_fanout_from_many_threads_at_once():
+    class Instance:
+        def __init__(self, n):
+            self.instance_id = 'i-%d' % n
+    def make_cmd(instance):
+        return ['bash', '-c', 'sleep .1; echo $0', instance.instance_id], None, None
+    instances = [Instance(n) for n in range(50)]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(ec2._ssh_fanout(instances, make_cmd, 0, lambda *a: None, lambda *a: None))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4
+    for result in results:
+        assert [stdout for _, stdout, _ in result] == [b'%s\n' % i.instance_id.encode() for i in instances]
+
+def test_new_returns_a_list_or_streams_ids_as_they_are_ready(monkeypatch):
+    created = []
+    class Resource:
+        def Subnet(self, id):
+            return types.SimpleNamespace(id=id)
+        def create_instances(self, **opts):
+            created.append(opts['MaxCount'])
+            return [types.SimpleNamespace(instance_id='i-%d' % n) for n in range(opts['MaxCount'])]
+    async def ssh_ready(launch, num, seconds):
+        for instance_id, _ in launch(num):
+            yield instance_id
+    monkeypatch.setattr(ec2, '_resource', Resource)
+    monkeypatch.setattr(ec2, '_sgs', lambda names: [types.SimpleNamespace(id='sg-1')])
+    monkeypatch.setattr(ec2, '_subnet', lambda vpc, zone: 'subnet-1')
+    monkeypatch.setattr(ec2, '_ssh_ready_as_completed', ssh_ready)
+    opts = dict(key='key', ami='ami-1', sg='sg', type='t3.micro', vpc='vpc', spot=0, num=2, init='')
+    assert ec2.new('name', **opts) == ['i-0', 'i-1']
+    ids = ec2.new('name', stream=True, **opts)
+    assert created == [2] # nothing launches until the stream is read
+    assert next(ids) == 'i-0'
+    assert list(ids) == ['i-1']
+    assert created == [2, 2]
+
+def test_scp_chunks_copies_ranges_both_ways_with_keepalives(hosts):
+    host = hosts.instances[0]
+    data = os.urandom(1024 * 1024 + 7)
+    with open('big.bin', 'wb') as f:
+        f.write(data)
+    assert ec2._scp_chunked(host, 'user', 'big.bin', ':~/', 4) == len(data)
+    with open(hosts.path(host, 'big.bin'), 'rb') as f:
+        assert f.read() == data
+    os.makedirs('down')
+    assert ec2._scp_chunked(host, 'user', ':big.bin', 'down', 4) == len(data)
+    with open('down/big.bin', 'rb') as f:
+        assert f.read() == data
+    for line in read(os.path.join(hosts.root, 'ssh.log')).splitlines():
+        assert 'ServerAliveInterval=15' in line
+        assert line.index('ControlMaster=no') < line.index('ControlMaster=auto')
+
+def test_pmap_source_reads_files_only_when_asked(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    write(str(tmp_path / 'args.txt'), 'a\nb\nc\n')
+    source = ec2._pmap_source('@args.txt')
+    assert next(source) == 3
+    assert list(source) == ['a', 'b', 'c']
+    assert list(ec2._pmap_source('args.txt')) == [1, 'args.txt']
+    monkeypatch.setattr('sys.stdin', io.StringIO('x\ny\n'))
+    assert list(ec2._pmap_source('-')) == [None, 'x', 'y']
+
+def test_pmap_args_from_a_file_and_stdin(hosts, monkeypatch):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    write(os.path.abspath('args.txt'), ''.join('%s\n' % n for n in range(10)))
+    assert ec2.pmap(ids, '@args.txt', "awk '{{print 2 * $1}}'", status_interval=1) == [str(n * 2) for n in range(10)]
+    monkeypatch.setattr('sys.stdin', io.StringIO('x\ny\n'))
+    assert ec2.pmap(ids, '-', 'tr a-z A-Z', status_interval=1) == ['X', 'Y']
+
+def test_spot_opts_weight_each_type_across_every_subnet(monkeypatch):
+    subnets = [types.SimpleNamespace(id='subnet-%s' % zone, availability_zone=zone) for zone in ['us-east-1a', 'us-east-1b', 'us-east-1a']]
+    vpc = types.SimpleNamespace(subnets=types.SimpleNamespace(all=lambda: subnets))
+    monkeypatch.setattr(ec2, '_resource', lambda: types.SimpleNamespace(vpcs=types.SimpleNamespace(filter=lambda **kw: [vpc])))
+    assert ec2._subnet('vpc-1', 'us-east-1b') == 'subnet-us-east-1b'
+    assert ec2._subnet('vpc-1', 'us-east-1a') == 'subnet-us-east-1a'
+    assert ec2._subnet('vpc-1', None) == 'subnet-us-east-1a'
+    assert [x.id for x in ec2._subnets('vpc-1', 'us-east-1a')] == ['subnet-us-east-1a', 'subnet-us-east-1a']
+    bids = [(name, weight, 0.1 * weight) for name, weight in ec2._parse_types('i3.large, i3.xlarge:2')]
+    assert [x[:2] for x in bids] == [('i3.large', 1), ('i3.xlarge', 2)]
+    bids[1] = ('i3.xlarge', 2, 0.3)
+    opts = {'MaxCount': 4, 'MinCount': 4, 'SecurityGroupIds': ['sg-1'], 'SubnetId': 'subnet-a,subnet-b', 'ImageId': 'ami-1'}
+    spot_opts = ec2._make_spot_opts(bids, opts, 'arn:aws:iam::1:role/fleet', 'lowestPrice')
+    assert spot_opts['TargetCapacity'] == 4
+    assert float(spot_opts['SpotPrice']) == pytest.approx(0.15)
+    specs = spot_opts['LaunchSpecifications']
+    assert [(x['InstanceType'], x['WeightedCapacity'], float(x['SpotPrice'])) for x in specs] == [('i3.large', 1, pytest.approx(0.1)), ('i3.xlarge', 2, pytest.approx(0.15))]
+    assert all(x['SubnetId'] == 'subnet-a,subnet-b' and x['SecurityGroups'] == [{'GroupId': 'sg-1'}] and 'MaxCount' not in x for x in specs)
+
+def test_pmap_resumes_from_its_journal_without_rerunning_finished_args(hosts):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    # c fails until ../fixed exists, and every run is logged
+    cmd = 'read x; echo $x >> ../runs.log; [ $x != c ] || [ -e ../fixed ] && echo $x-done'
+    with pytest.raises(AssertionError):
+        ec2.pmap(ids, 'a,b,c,d', cmd, retries=1, status_interval=1)
+    [journal] = [x for x in os.listdir('home/.cache/py-aws') if x.endswith('.sqlite')]
+    session = journal.split('.')[1]
+    write(os.path.join(hosts.root, 'fixed'), '')
+    time.sleep(.5)
+    assert ec2.pmap(ids, 'a,b,c,d', cmd, status_interval=1, resume=session) == ['a-done', 'b-done', 'c-done', 'd-done']
+    assert sorted(read(os.path.join(hosts.root, 'runs.log')).split()) == ['a', 'b', 'c', 'c', 'd']
+    assert not os.listdir('home/.cache/py-aws')
+    with pytest.raises(AssertionError):
+        ec2.pmap(ids, 'a,b,c,d', cmd, resume=session)
+
+def test_pmap_stats_count_retries_latency_and_overhead(hosts, tmp_path, caplog):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    # e fails the first time it runs
+    cmd = 'x=$(cat); if [ $x = e ] && [ ! -e ../e.failed ]; then touch ../e.failed; exit 1; fi; sleep .2; echo $x'
+    caplog.set_level('INFO')
+    results = ec2.pmap(ids, 'a,b,c,d,e,f', cmd, retry_sleep=0, status_interval=1, stats_file=str(tmp_path / 'stats.json'))
+    assert results == ['a', 'b', 'c', 'd', 'e', 'f']
+    with open(str(tmp_path / 'stats.json')) as f:
+        stats = json.load(f)
+    assert (stats['done'], stats['remaining'], stats['queued'], stats['running'], stats['retries']) == (6, 0, 0, 0, 1)
+    assert set(stats['latency_histogram']) <= {i.instance_id for i in hosts.instances}
+    assert sum(n for counts in stats['latency_histogram'].values() for n in counts.values()) == 7
+    assert stats['mean_runtime_seconds'] >= .15 and stats['mean_ssh_overhead_seconds'] >= 0
+    assert stats['args_per_second_total'] > 0
+    assert any(x.startswith('pmap: 6 done, 0 remaining') for x in caplog.messages)
+
+def test_pmap_drops_a_host_which_dies_mid_job_and_requeues_its_args(hosts, monkeypatch):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    monkeypatch.setattr(ec2, '_pmap_silent_seconds', 1)
+    monkeypatch.setattr(ec2, '_pmap_silent_check_seconds', .5)
+    # the first run of a takes its host down with it
+    cmd = 'x=$(cat); if [ $x = a ] && [ ! -e ../a.started ]; then touch ../a.started; touch ../$(basename $PWD).dead; sleep 10; fi; echo $x'
+    start = time.time()
+    assert ec2.pmap(ids, 'a,b,c,d,e,f', cmd, retry_sleep=0, status_interval=1) == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert time.time() - start < 8
+    [dead] = [i for i in hosts.instances if os.path.exists(os.path.join(hosts.root, i.public_dns_name + '.dead'))]
+    assert read(hosts.path(dead, 'cmds.log')).count('\n') == 1
+
+def test_pmap_batches_args_into_jobs_but_retries_them_one_by_one(hosts):
+    host = hosts.instances[0]
+    # c fails the first time it runs
+    cmd = 'x=$(cat); echo $x >> ../runs.log; if [ $x = c ] && [ ! -e ../c.failed ]; then touch ../c.failed; exit 1; fi; echo $x'
+    assert ec2.pmap(host.instance_id, 'a,b,c,d,e,f,g', cmd, batch_size=3, retry_sleep=0, status_interval=1) == ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+    assert sorted(read(os.path.join(hosts.root, 'runs.log')).split()) == ['a', 'b', 'c', 'c', 'd', 'e', 'f', 'g']
+    assert read(hosts.path(host, 'cmds.log')).count('\n') <= 4 # a-c, d-f, then g and the retry of c
+    os.remove(hosts.path(host, 'cmds.log'))
+    assert ec2.pmap(host.instance_id, 'aaaa,bbbb,cccc,dddd,eeee', 'cat', batch_size=10, batch_bytes=8, status_interval=1) == ['aaaa', 'bbbb', 'cccc', 'dddd', 'eeee']
+    assert read(hosts.path(host, 'cmds.log')).count('\n') == 3
+
+def test_push_broadcasts_one_compressed_archive_and_syncs_only_changes(hosts):
+    write('proj/a.txt', 'a')
+    write('proj/sub/b.txt', 'b')
+    bundles = set(os.listdir('/tmp'))
+    ec2.push('proj', 'dst', 'all', yes=True, compress='gzip', broadcast=True)
+    for host in hosts.instances:
+        assert read(hosts.path(host, 'dst/proj/a.txt')) == 'a'
+        assert read(hosts.path(host, 'dst/proj/sub/b.txt')) == 'b'
+    # here sends to one host, then here and that host send to one more each
+    log = read(os.path.join(hosts.root, 'ssh.log')).splitlines()
+    assert len([x for x in log if x.startswith('-A ')]) == 1
+    assert {x for x in os.listdir('/tmp') if x.startswith('py-aws-push.')} <= bundles
+    # sync sends only what changed since the last sync to each host
+    ec2.push('proj', 'dst', 'all', yes=True, sync=True, compress='gzip')
+    for host in hosts.instances:
+        write(hosts.path(host, 'dst/proj/a.txt'), 'changed remotely')
+    write('proj/sub/b.txt', 'b2')
+    ec2.push('proj', 'dst', 'all', yes=True, sync=True, compress='gzip')
+    for host in hosts.instances:
+        assert read(hosts.path(host, 'dst/proj/a.txt')) == 'changed remotely'
+        assert read(hosts.path(host, 'dst/proj/sub/b.txt')) == 'b2'
+
+def test_pull_from_many_hosts_into_a_directory_each(hosts):
+    for host in hosts.instances:
+        write(hosts.path(host, 'logs/out.log'), host.instance_id)
+        write(hosts.path(host, 'logs/skip.txt'), 'skip')
+    ec2.pull('logs', 'gathered', 'all', yes=True, name='*.log')
+    for host in hosts.instances:
+        assert os.listdir(os.path.join('gathered', host.instance_id, 'logs')) == ['out.log']
+        assert read(os.path.join('gathered', host.instance_id, 'logs/out.log')) == host.instance_id
+    # one host goes straight into dst, and without a preview there is one ssh per host
+    host = hosts.instances[1]
+    os.remove(os.path.join(hosts.root, 'ssh.log'))
+    ec2.pull('logs', 'one', host.instance_id, yes=True, compress='none', no_preview=True)
+    assert sorted(os.listdir('one/logs')) == ['out.log', 'skip.txt']
+    assert len(read(os.path.join(hosts.root, 'ssh.log')).splitlines()) == 1
+
+def test_pmap_streams_results_in_arg_order(hosts, capsys):
+    ids = ','.join(i.instance_id for i in hosts.instances)
+    cmd = 'x=$(cat); [ $x = a ] && sleep 1; echo $x'
+    assert ec2.pmap(ids, 'a,b,c,d,e', cmd, stream_results='ordered', status_interval=1) is None
+    lines = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    assert lines == [{'arg_num': n, 'result': x} for n, x in enumerate('abcde')]
+    assert ec2.pmap(ids, 'a,b,c,d,e', cmd, stream_results='unordered', status_interval=1) is None
+    lines = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    assert lines[-1] == {'arg_num': 0, 'result': 'a'}
+    assert sorted(x['arg_num'] for x in lines) == list(range(5))